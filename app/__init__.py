@@ -19,7 +19,8 @@ randcol = randomcolor.RandomColor()
 from app.resources.assemblies import AssembliesApi
 from app.resources.assembly import AssemblyApi
 from app.resources.contigs import ContigsApi
-from app.resources.contigs_plot import ContigsPlotApi
+from app.resources.contigs_plot import ContigsPlotApi, ContigsDensityApi
+from app.resources.contigs_tiles import ContigsTileApi
 from app.resources.bin_sets import BinSetsApi
 from app.resources.bin_set import BinSetApi, BinSetExportApi
 from app.resources.bins import BinsApi
@@ -27,17 +28,20 @@ from app.resources.bin import BinApi, BinExportApi
 from app.resources.matrix import MatrixApi
 from app.resources.hmmer import HmmerApi
 from app.resources.jobs import JobsApi, JobApi
-from app.resources.assess import AssessApi
+from app.resources.assess import AssessApi, AssessTargetsApi
 
 api = Api(app)
 api.add_resource(AssembliesApi, '/a')
 api.add_resource(AssemblyApi, '/a/<int:id>')
 api.add_resource(ContigsApi, '/a/<int:assembly_id>/c')
 api.add_resource(ContigsPlotApi, '/a/<int:assembly_id>/c/plot')
+api.add_resource(ContigsDensityApi, '/a/<int:assembly_id>/c/density')
+api.add_resource(ContigsTileApi, '/a/<int:assembly_id>/c/tiles/<int:zoom>/<int:tx>/<int:ty>')
 api.add_resource(BinSetsApi, '/a/<int:assembly_id>/bs')
 api.add_resource(BinSetApi, '/a/<int:assembly_id>/bs/<int:id>')
 api.add_resource(BinSetExportApi, '/a/<int:assembly_id>/bs/<int:id>/export')
 api.add_resource(AssessApi, '/a/<int:assembly_id>/bs/<int:id>/assess')
+api.add_resource(AssessTargetsApi, '/a/<int:assembly_id>/bs/<int:id>/assess/targets')
 api.add_resource(BinsApi, '/a/<int:assembly_id>/bs/<int:id>/b')
 api.add_resource(BinApi, '/a/<int:assembly_id>/bs/<int:bin_set_id>/b/<int:id>')
 api.add_resource(BinExportApi, '/a/<int:assembly_id>/bs/<int:bin_set_id>/b/<int:id>/export')
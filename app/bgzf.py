@@ -0,0 +1,223 @@
+import os
+import zlib
+import struct
+from bisect import bisect_right
+from collections import OrderedDict
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+# Uncompressed bytes per block, as bgzip does.
+BLOCK_SIZE = 0xff00
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def is_bgzf_header(header):
+    """
+    :param header: The first 18 bytes of a file.
+    """
+    return (len(header) >= 18 and header[:2] == GZIP_MAGIC and header[3] & 4 and
+            header[12:14] == b'BC')
+
+
+def _block_size(f):
+    """
+    :return: Size of the block starting at the position of `f`, or None at
+        the end of the file.
+    """
+    header = f.read(12)
+    if len(header) < 12:
+        return None
+    if header[:2] != GZIP_MAGIC or not header[3] & 4:
+        raise ValueError('Not a bgzip file')
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = f.read(xlen)
+    position = 0
+    while position + 4 <= xlen:
+        slen, = struct.unpack('<H', extra[position + 2:position + 4])
+        if extra[position:position + 2] == b'BC':
+            bsize, = struct.unpack('<H', extra[position + 4:position + 6])
+            return bsize + 1
+        position += 4 + slen
+    raise ValueError('Not a bgzip file')
+
+
+def _walk_blocks(f, coffsets, uoffsets):
+    # Extend the offsets with the blocks after the last offset.
+    while True:
+        f.seek(coffsets[-1])
+        size = _block_size(f)
+        if size is None:
+            return
+        f.seek(coffsets[-1] + size - 4)
+        isize, = struct.unpack('<I', f.read(4))
+        coffsets.append(coffsets[-1] + size)
+        uoffsets.append(uoffsets[-1] + isize)
+
+
+def build_index(path):
+    """
+    :return: Lists of the compressed and the uncompressed start offset of
+        every block, ending with the offsets of the end of the file.
+    """
+    coffsets, uoffsets = [0], [0]
+    with open(path, 'rb') as f:
+        _walk_blocks(f, coffsets, uoffsets)
+    return coffsets, uoffsets
+
+
+def write_index(path, coffsets, uoffsets):
+    """
+    Write the index in the .gzi format of bgzip: the number of entries and
+    the offset pairs of every block but the first, as little-endian uint64.
+    """
+    pairs = list(zip(coffsets[1:-1], uoffsets[1:-1]))
+    with open(path + '.gzi', 'wb') as f:
+        f.write(struct.pack('<Q', len(pairs)))
+        for pair in pairs:
+            f.write(struct.pack('<QQ', *pair))
+
+
+def read_index(path):
+    """
+    :return: The index of `build_index`, from the .gzi file when there is one.
+    """
+    if not os.path.exists(path + '.gzi'):
+        return build_index(path)
+    coffsets, uoffsets = [0], [0]
+    with open(path + '.gzi', 'rb') as f:
+        count, = struct.unpack('<Q', f.read(8))
+        for _ in range(count):
+            coffset, uoffset = struct.unpack('<QQ', f.read(16))
+            coffsets.append(coffset)
+            uoffsets.append(uoffset)
+    # The .gzi has no end offsets, walk the blocks after the last entry.
+    with open(path, 'rb') as f:
+        _walk_blocks(f, coffsets, uoffsets)
+    return coffsets, uoffsets
+
+
+class BgzfWriter:
+    """
+    File object writing bgzip blocks. The block index is written next to
+    the file on close.
+    """
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        self.f = open(path, 'wb')
+        self.buffer = bytearray()
+        self.coffsets, self.uoffsets = [0], [0]
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        header = GZIP_MAGIC + b'\x08\x04' + b'\x00' * 4 + b'\x00\xff' + \
+            struct.pack('<H', 6) + b'BC' + struct.pack('<HH', 2, len(cdata) + 25)
+        self.f.write(header)
+        self.f.write(cdata)
+        self.f.write(struct.pack('<II', zlib.crc32(data), len(data)))
+        self.coffsets.append(self.coffsets[-1] + len(cdata) + 26)
+        self.uoffsets.append(self.uoffsets[-1] + len(data))
+
+    def close(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.f.write(EOF_BLOCK)
+        self.f.close()
+        write_index(self.path, self.coffsets, self.uoffsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BgzfFile:
+    """
+    Random access to the uncompressed data of a bgzip file. Supports the
+    `len`, slicing and `find` operations of mmap, so that the fasta reader
+    can work on either. Recently used blocks are kept decompressed.
+    """
+    def __init__(self, path, cache_size=64):
+        self.f = open(path, 'rb')
+        self.coffsets, self.uoffsets = read_index(path)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return self.uoffsets[-1]
+
+    def _block(self, i):
+        data = self.cache.get(i)
+        if data is not None:
+            self.cache.move_to_end(i)
+            return data
+        start, end = self.coffsets[i], self.coffsets[i + 1]
+        self.f.seek(start)
+        block = self.f.read(end - start)
+        xlen, = struct.unpack('<H', block[10:12])
+        data = zlib.decompress(block[12 + xlen:-8], -15)
+        self.cache[i] = data
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return data
+
+    def _block_of(self, offset):
+        return bisect_right(self.uoffsets, offset) - 1
+
+    def read(self, start, end):
+        start, end = max(start, 0), min(end, len(self))
+        if start >= end:
+            return b''
+        first, last = self._block_of(start), self._block_of(end - 1)
+        data = b''.join(self._block(i) for i in range(first, last + 1))
+        base = self.uoffsets[first]
+        return data[start - base:end - base]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(len(self))
+            return self.read(start, stop)
+        return self.read(key, key + 1)[0]
+
+    def find(self, sub, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        if start >= end:
+            return -1
+        i = self._block_of(start)
+        # Carry the tail of the previous block to find matches across blocks.
+        tail, tail_start = b'', start
+        while i < len(self.uoffsets) - 1 and self.uoffsets[i] < end:
+            base = self.uoffsets[i]
+            data = self._block(i)
+            window = tail + data[max(start - base, 0):end - base]
+            found = window.find(sub)
+            if found != -1:
+                return tail_start + found
+            tail = window[-(len(sub) - 1):] if len(sub) > 1 else b''
+            tail_start = tail_start + len(window) - len(tail)
+            i += 1
+        return -1
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
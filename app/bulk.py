@@ -0,0 +1,136 @@
+import io
+from time import perf_counter
+from itertools import islice
+
+from sqlalchemy import bindparam
+
+from app import db, app
+from app.models import Contig, EssentialGene, gencontig
+
+
+CONTIG_COLUMNS = ['assembly_id', 'name', 'length', 'gc', 'fourmers', 'coverage_values',
+                  'pc_1', 'pc_2', 'pc_3']
+
+
+def insert_contigs(assembly_id, rows, batch_size=20000, checkpoint=None):
+    """
+    Insert contigs with Core executemany, or COPY on PostgreSQL, committing
+    every batch.
+
+    :param assembly_id: Id of the assembly the contigs belong to.
+    :param rows: Iterable of dicts with the contig columns, in insert order.
+    :param batch_size: How many contigs to insert per batch.
+    :param checkpoint: Called before every commit, to record progress in
+        the same transaction as the batch.
+    :return: Number of contigs inserted and the rate in rows per second.
+    """
+    rows = iter(rows)
+    count = 0
+    start = perf_counter()
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        for row in batch:
+            row['assembly_id'] = assembly_id
+        _insert(Contig.__table__, CONTIG_COLUMNS, batch)
+        if checkpoint is not None:
+            checkpoint()
+        db.session.commit()
+
+        count += len(batch)
+        app.logger.debug('At: {} ({:.0f} rows/s)'.format(count, count / (perf_counter() - start)))
+    rate = count / (perf_counter() - start) if count else 0
+    app.logger.info('Inserted {} contigs at {:.0f} rows/s'.format(count, rate))
+    return count, rate
+
+
+def link_essential_genes(assembly_id, essential_genes, chunk_size=20000):
+    """
+    Insert the gencontig links of contigs that are already saved.
+
+    :param essential_genes: Dict contig name -> list of essential gene names.
+    """
+    gene_ids = essential_gene_ids()
+    for rows in iter_contig_chunks(assembly_id, ['name'], chunk_size):
+        links = [{'gene_id': gene_ids[gene], 'contig_id': id}
+                 for id, name in rows
+                 for gene in essential_genes.get(name, [])]
+        _insert(gencontig, ['gene_id', 'contig_id'], links)
+        db.session.commit()
+
+
+def unlink_essential_genes(assembly_id):
+    contigs = db.session.query(Contig.id).filter(Contig.assembly_id == assembly_id)
+    db.session.execute(gencontig.delete().where(gencontig.c.contig_id.in_(contigs.subquery())))
+    db.session.commit()
+
+
+def essential_gene_ids():
+    genes = EssentialGene.query.filter_by(source='essential'). \
+        with_entities(EssentialGene.name, EssentialGene.id)
+    return dict(genes.all())
+
+
+def _insert(table, columns, rows):
+    if not rows:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        _copy(table, columns, rows)
+    else:
+        db.session.execute(table.insert(), rows)
+
+
+def _copy(table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(row.get(column)) for column in columns))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table.name, ', '.join(columns)),
+                       buffer)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        return '\\\\x' + value.hex()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t'). \
+        replace('\n', '\\n').replace('\r', '\\r')
+
+
+def iter_contig_chunks(assembly_id, columns, chunk_size=10000):
+    """
+    :param columns: Contig columns to load besides the id.
+    :return: Generator of lists of (id, *columns) rows in id order, paged on
+        the id so that every chunk is a cheap index range scan.
+    """
+    columns = [getattr(Contig, column) for column in columns]
+    last_id = 0
+    while True:
+        rows = db.session.query(Contig.id, *columns). \
+            filter(Contig.assembly_id == assembly_id, Contig.id > last_id). \
+            order_by(Contig.id). \
+            limit(chunk_size). \
+            all()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][0]
+
+
+def update_contigs(rows):
+    """
+    :param rows: List of dicts with the contig `_id` and the values of the
+        columns to update.
+    """
+    if not rows:
+        return
+    table = Contig.__table__
+    columns = [column for column in rows[0] if column != '_id']
+    statement = table.update(). \
+        where(table.c.id == bindparam('_id')). \
+        values({column: bindparam(column) for column in columns})
+    db.session.execute(statement, rows)
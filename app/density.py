@@ -0,0 +1,181 @@
+from functools import lru_cache
+
+import numpy as np
+
+from app import db, utils
+from app.models import Assembly, Contig, Bin, bincontig
+
+
+AXES = ['gc', 'length', 'pc_1', 'pc_2', 'pc_3']
+# Prefix of the axes of the log10(coverage + 1) of a sample, which keeps
+# contigs without coverage in the sample at 0.
+COVERAGE_AXIS = 'coverage:'
+
+
+class ContigColumns:
+    """
+    The plottable columns of the contigs of an assembly as arrays, ordered
+    by contig id. Missing values are NaN.
+    """
+    def __init__(self, assembly):
+        rows = db.session.query(Contig.id, Contig.length, Contig.gc, Contig.pc_1,
+                                Contig.pc_2, Contig.pc_3, Contig.coverage_values). \
+            filter(Contig.assembly_id == assembly.id). \
+            order_by(Contig.id). \
+            all()
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.length = np.array([row[1] for row in rows], dtype=np.int64)
+        values = np.array([row[2:6] for row in rows], dtype=np.float64).reshape(-1, 4)
+        self.columns = dict(zip(AXES, [values[:, 0], self.length.astype(np.float64),
+                                       *values[:, 1:].T]))
+        self.samples = assembly.coverage_samples
+        self.coverages = utils.packed_matrix((row[6] for row in rows), len(self.samples))
+
+    def axis(self, name):
+        """
+        :param name: One of AXES or COVERAGE_AXIS followed by a sample name.
+        :raise KeyError: For unknown axes.
+        """
+        if name.startswith(COVERAGE_AXIS):
+            sample = name[len(COVERAGE_AXIS):]
+            if sample not in self.samples:
+                raise KeyError(name)
+            sample = self.samples.index(sample)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.log10(self.coverages[:, sample].astype(np.float64) + 1)
+        return self.columns[name]
+
+    def positions(self, contig_ids):
+        """
+        :return: Position in the columns of each contig id.
+        """
+        return np.searchsorted(self.ids, contig_ids)
+
+
+def axis_names(assembly):
+    return AXES + [COVERAGE_AXIS + sample for sample in assembly.coverage_samples]
+
+
+def contig_columns(assembly):
+    """
+    :return: The ContigColumns of the assembly, cached once it is saved.
+    """
+    if assembly.busy:
+        return ContigColumns(assembly)
+    return _contig_columns(assembly.id, assembly.submit_date, assembly.pca_done)
+
+
+@lru_cache(maxsize=4)
+def _contig_columns(assembly_id, submit_date, pca_done):
+    return ContigColumns(Assembly.query.get(assembly_id))
+
+
+def bin_membership(columns, bin_set):
+    """
+    :return: The bins of the bin set as list of (id, name, color) and per
+        contig in `columns` the position of its bin in that list, -1 when
+        it is in none.
+    """
+    bins = db.session.query(Bin.id, Bin.name, Bin.color). \
+        filter(Bin.bin_set_id == bin_set.id). \
+        order_by(Bin.id). \
+        all()
+    rows = np.array(db.session.query(bincontig.c.contig_id, bincontig.c.bin_id).
+                    join(Bin, Bin.id == bincontig.c.bin_id).
+                    filter(Bin.bin_set_id == bin_set.id).
+                    all(), dtype=np.int64).reshape(-1, 2)
+    groups = np.full(len(columns.ids), -1, dtype=np.int64)
+    bin_ids = np.array([id for id, *_ in bins], dtype=np.int64)
+    groups[columns.positions(rows[:, 0])] = np.searchsorted(bin_ids, rows[:, 1])
+    return bins, groups
+
+
+def data_extent(x, y):
+    """
+    :return: (xmin, xmax, ymin, ymax) of the finite points, widened where
+        it would be empty.
+    """
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.any():
+        return 0., 1., 0., 1.
+    extent = []
+    for values in (x[finite], y[finite]):
+        low, high = float(values.min()), float(values.max())
+        if low == high:
+            low, high = low - .5, high + .5
+        extent += [low, high]
+    return tuple(extent)
+
+
+def cell_indices(x, y, extent, size):
+    """
+    :param extent: (xmin, xmax, ymin, ymax), points on the upper edges
+        fall in the last cells.
+    :param size: Number of cells along x and y.
+    :return: The x and y cell index of the points inside the extent, and
+        the mask of those points.
+    """
+    xmin, xmax, ymin, ymax = extent
+    nx, ny = size
+    with np.errstate(invalid='ignore'):
+        inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+    # Searching the edges puts values on an edge in the same cell as
+    # np.histogram2d would, where dividing by the cell width may not.
+    ix = np.searchsorted(np.linspace(xmin, xmax, nx + 1), x[inside], 'right') - 1
+    iy = np.searchsorted(np.linspace(ymin, ymax, ny + 1), y[inside], 'right') - 1
+    return np.minimum(ix, nx - 1), np.minimum(iy, ny - 1), inside
+
+
+def grid_cells(x, y, extent, size):
+    """
+    :return: Flat cell index, x index * ny + y index, of the points inside
+        the extent and the mask of those points, see `cell_indices`.
+    """
+    ix, iy, inside = cell_indices(x, y, extent, size)
+    return ix * size[1] + iy, inside
+
+
+def aggregate(cells, lengths, size, groups=None):
+    """
+    Count the points and sum their lengths per cell, and per group of the
+    points when `groups` is given.
+    :return: Sparse list of [x index, y index, count, bp] per non-empty cell,
+        or a dict group -> such list.
+    """
+    nx, ny = size
+    keys = cells if groups is None else groups * (nx * ny) + cells
+    keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    bp = np.bincount(inverse, weights=lengths, minlength=len(keys)).astype(np.int64)
+    group, cell = np.divmod(keys, nx * ny)
+    rows = np.column_stack([cell // ny, cell % ny, counts, bp]).tolist()
+    if groups is None:
+        return rows
+    result = {}
+    for g, row in zip(group.tolist(), rows):
+        result.setdefault(g, []).append(row)
+    return result
+
+
+def density(columns, x_axis, y_axis, extent=None, size=(100, 100), bin_set=None):
+    """
+    2D histogram of the contigs on two axes: the number of contigs and
+    their summed length per cell of a grid over `extent`, which defaults to
+    that of the data. Contigs with missing values on an axis are left out.
+    :param bin_set: Also break the cells down by the bins of this bin set.
+    :raise KeyError: For unknown axes.
+    """
+    x, y = columns.axis(x_axis), columns.axis(y_axis)
+    if extent is None:
+        extent = data_extent(x, y)
+    cells, inside = grid_cells(x, y, extent, size)
+    lengths = columns.length[inside]
+    data = {'x': x_axis, 'y': y_axis, 'extent': list(extent), 'size': list(size),
+            'count': int(inside.sum()), 'cells': aggregate(cells, lengths, size)}
+    if bin_set is not None:
+        bins, groups = bin_membership(columns, bin_set)
+        groups = groups[inside]
+        binned = groups != -1
+        per_bin = aggregate(cells[binned], lengths[binned], size, groups[binned])
+        data['bins'] = [{'id': id, 'name': name, 'color': color, 'cells': per_bin.get(i, [])}
+                        for i, (id, name, color) in enumerate(bins)]
+    return data
@@ -0,0 +1,230 @@
+import os
+import mmap
+import tempfile
+from contextlib import contextmanager
+from collections import namedtuple
+
+from app import bgzf
+
+
+# Blanks besides line breaks, stripped from the end of sequence lines.
+BLANKS = b' \t\x0b\x0c'
+
+FastaRecord = namedtuple('FastaRecord', ['name', 'offset', 'length', 'sequence', 'end'])
+IndexEntry = namedtuple('IndexEntry', ['length', 'offset', 'linebases', 'linewidth'])
+
+
+@contextmanager
+def open_fasta(path):
+    """
+    Open the uncompressed contents of a plain or bgzip compressed fasta
+    file, as a mmap or a BgzfFile that both support `len`, slicing and
+    `find`. Offsets are always those of the uncompressed data.
+    """
+    if bgzf.is_gzip(path):
+        with bgzf.BgzfFile(path) as f:
+            yield f
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def read_fasta(path, headers_only=False, start=0, end=None):
+    """
+    :param path: Path of the plain or bgzip compressed fasta file.
+    :param headers_only: Skip building the sequences, `sequence` is None.
+    :param start: Byte offset to start reading from, e.g. from `fasta_shards`.
+    :param end: Byte offset to stop reading at, defaults to the end of file.
+    :return: Generator of FastaRecord tuples. `offset` is the byte offset of
+        the first sequence line, `length` the number of bases, `sequence`
+        the bases as bytes without line breaks and trailing blanks, and
+        `end` the byte offset where the next record starts.
+    """
+    with open_fasta(path) as mm:
+        end = len(mm) if end is None else min(end, len(mm))
+        yield from _read_records(mm, start, end, headers_only)
+
+
+def fasta_shards(path, shard_size, start=0):
+    """
+    Split the fasta file, from byte offset `start` on, in byte ranges of
+    roughly `shard_size` bytes that start at a header, to be read with
+    `read_fasta(path, start=, end=)`.
+    """
+    with open_fasta(path) as mm:
+        size = len(mm)
+        shards = []
+        start = mm.find(b'>', start)
+        while start != -1 and start < size:
+            end = mm.find(b'\n>', start + max(shard_size, 1) - 1)
+            end = size if end == -1 else end + 1
+            shards.append((start, end))
+            start = end
+        return shards
+
+
+def split_fasta(path, dirname, count):
+    """
+    Write the fasta file as `count` uncompressed shards of about equal size
+    to `dirname`.
+    :return: The paths of the shards.
+    """
+    paths = []
+    with open_fasta(path) as mm:
+        shards = fasta_shards(path, -(-len(mm) // count))
+        for i, (start, end) in enumerate(shards):
+            shard_path = os.path.join(dirname, 'shard_{}.fa'.format(i))
+            with open(shard_path, 'wb') as f:
+                for chunk_start in range(start, end, 1024 * 1024):
+                    f.write(mm[chunk_start:min(chunk_start + 1024 * 1024, end)])
+            paths.append(shard_path)
+    return paths
+
+
+def write_index(path):
+    """
+    Write a samtools style .fai index of the fasta file next to it: per
+    contig the name, length, offset of the sequence, bases per line and
+    bytes per line. A record with lines of irregular length is indexed as
+    one line spanning the record, which still reads the whole sequence.
+    The index is written to a temporary file first, so that concurrent
+    writers do not mix their output.
+    """
+    with open_fasta(path) as mm, tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(path), suffix='.fai.tmp', delete=False) as f:
+        for record in _read_records(mm, 0, len(mm), headers_only=True):
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(record.name.split(' ')[0], record.length,
+                                                  record.offset, *_line_size(mm, record)))
+    os.replace(f.name, path + '.fai')
+
+
+def read_index(path):
+    """
+    :return: Dict contig name -> IndexEntry from the .fai index of the fasta
+        file, which is written first when there is none.
+    """
+    if not os.path.exists(path + '.fai'):
+        write_index(path)
+    index = {}
+    with open(path + '.fai') as f:
+        for line in f:
+            name, *values = line.rstrip('\n').split('\t')
+            index[name] = IndexEntry(*map(int, values[:4]))
+    return index
+
+
+def read_sequences(path, names, index=None, headers=False):
+    """
+    Read the sequences of the given contigs only, seeking to them with the
+    .fai index.
+    :param names: Contig names, those not in the fasta file are skipped.
+    :param index: The index of `read_index`, read when not given.
+    :param headers: Give the whole header line, with the description,
+        instead of the name.
+    :return: Generator of (name or header, sequence as bytes) in fasta order.
+    """
+    if index is None:
+        index = read_index(path)
+    entries = sorted((index[name].offset, name) for name in names if name in index)
+    with open_fasta(path) as mm:
+        for _, name in entries:
+            entry = index[name]
+            size = _sequence_size(entry.length, entry.linebases, entry.linewidth)
+            sequence = _clean_sequence(mm[entry.offset:entry.offset + size])
+            yield _header(mm, entry.offset) if headers else name, sequence
+
+
+def _header(mm, offset, size=256):
+    # The header line ends right before the sequence starts, search back
+    # for the line break before it.
+    end = offset - 1
+    while True:
+        start = max(end - size, 0)
+        window = mm[start:end]
+        eol = window.rfind(b'\n')
+        if eol != -1 or start == 0:
+            return window[eol + 1:].rstrip(b'\r')[1:].decode()
+        size *= 2
+
+
+def _sequence_size(length, linebases, linewidth):
+    if linebases == 0:
+        return 0
+    return length // linebases * linewidth + length % linebases
+
+
+def _line_size(mm, record):
+    region_size = record.end - record.offset
+    eol = mm.find(b'\n', record.offset, record.end)
+    line_end = record.end if eol == -1 else eol
+    linewidth = line_end - record.offset + (eol != -1)
+    linebases = line_end - record.offset - (mm[line_end - 1:line_end] == b'\r')
+    if linebases == 0 or not _is_regular(mm, record, linebases, linewidth):
+        return record.length, region_size
+    return linebases, linewidth
+
+
+def _is_regular(mm, record, linebases, linewidth, chunk_size=1024 * 1024):
+    # Whether the lines of `linebases` bases span exactly the sequence,
+    # checked in chunks of whole lines instead of copying the sequence.
+    stop = record.offset + _sequence_size(record.length, linebases, linewidth)
+    step = linewidth * max(1, chunk_size // linewidth)
+    length = 0
+    for start in range(record.offset, stop, step):
+        chunk = mm[start:min(start + step, stop)]
+        if _has_blanks(chunk):
+            return False
+        length += len(chunk) - chunk.count(b'\n') - chunk.count(b'\r')
+    return length == record.length
+
+
+def _has_blanks(data):
+    return any(data.find(blank) != -1 for blank in BLANKS)
+
+
+def _clean_sequence(region):
+    """
+    :return: The bases of the lines of the region, without line breaks and
+        trailing blanks like `str.rstrip` of every line.
+    """
+    sequence = region.translate(None, b'\r\n')
+    if _has_blanks(sequence):
+        lines = region.replace(b'\r', b'\n').split(b'\n')
+        sequence = b''.join(line.rstrip() for line in lines)
+    return sequence
+
+
+def _sequence_length(mm, start, stop, chunk_size=1024 * 1024):
+    # Counts the bases in chunks instead of copying the whole region.
+    length = 0
+    for chunk_start in range(start, stop, chunk_size):
+        chunk = mm[chunk_start:min(chunk_start + chunk_size, stop)]
+        if _has_blanks(chunk):
+            return len(_clean_sequence(mm[start:stop]))
+        length += len(chunk) - chunk.count(b'\n') - chunk.count(b'\r')
+    return length
+
+
+def _read_records(mm, start, end, headers_only):
+    position = mm.find(b'>', start, end)
+    while position != -1:
+        eol = mm.find(b'\n', position, end)
+        if eol == -1:
+            eol = end
+        name = mm[position + 1:eol].rstrip().decode()
+        offset = eol + 1
+        # The record ends where the next header starts.
+        next_header = mm.find(b'\n>', eol, end)
+        stop = end if next_header == -1 else next_header + 1
+        if headers_only:
+            sequence = None
+            length = _sequence_length(mm, offset, stop)
+        else:
+            sequence = _clean_sequence(mm[offset:stop]) if offset < stop else b''
+            length = len(sequence)
+        yield FastaRecord(name, offset, length, sequence, stop)
+        position = -1 if next_header == -1 else stop
@@ -0,0 +1,102 @@
+import os
+import hashlib
+import tempfile
+from itertools import islice
+
+import numpy as np
+
+from app import app, fasta, bulk
+
+
+PC_COLUMNS = ['pc_1', 'pc_2', 'pc_3']
+
+
+def cache_path(content_hash, *names):
+    return os.path.join(app.config['BASEDIR'], 'data/cache', content_hash, *names)
+
+
+def copy_hashed(source, f=None, chunk_size=1024 * 1024):
+    """
+    Read `source` to the end, writing it to `f` if given.
+    :return: The sha256 hex digest of the data.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: source.read(chunk_size), b''):
+        digest.update(chunk)
+        if f is not None:
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def has_features(content_hash, calculate_fourmers):
+    path = cache_path(content_hash, 'features.npy')
+    if not os.path.exists(path):
+        return False
+    return not calculate_fourmers or _has_fourmers(path)
+
+
+def _has_fourmers(path):
+    # The file starts with an empty chunk that only holds the fields.
+    with open(path, 'rb') as f:
+        return 'fourmers' in np.load(f).dtype.names
+
+
+def _iter_chunks(path):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while f.tell() < size:
+            yield np.load(f)
+
+
+def iter_rows(content_hash, calculate_fourmers):
+    """
+    :return: Generator of (fasta end offset, contig row) from the cache, in
+        fasta order. Rows hold the principal components when
+        `calculate_fourmers`.
+    """
+    for chunk in _iter_chunks(cache_path(content_hash, 'features.npy')):
+        for record in chunk:
+            row = {'name': str(record['name']), 'length': int(record['length']),
+                   'gc': float(record['gc']), 'fourmers': None}
+            if calculate_fourmers:
+                row['fourmers'] = record['fourmers'].tobytes()
+                row.update(zip(PC_COLUMNS, record['pcs'].tolist()))
+            yield int(record['end']), row
+
+
+def save_features(content_hash, assembly, fasta_path, chunk_size=20000):
+    """
+    Store the features of the saved contigs of the assembly in the cache,
+    unless the cache already has them. The contigs are read in id order,
+    which is the fasta order they were inserted in. The cache is written to
+    a temporary file first, so that concurrent uploads of the same file do
+    not mix their output.
+    """
+    calculate_fourmers = assembly.has_fourmerfreqs
+    if has_features(content_hash, calculate_fourmers):
+        return
+    path = cache_path(content_hash, 'features.npy')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    columns = ['name', 'length', 'gc']
+    fields = [('length', np.int64), ('gc', np.float64), ('end', np.int64)]
+    if calculate_fourmers:
+        columns += ['fourmers'] + PC_COLUMNS
+        fields += [('fourmers', np.float32, 4 ** 4), ('pcs', np.float64, 3)]
+    records = fasta.read_fasta(fasta_path, headers_only=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.npy.tmp',
+                                     delete=False) as f:
+        np.save(f, np.zeros(0, [('name', 'U1')] + fields))
+        for rows in bulk.iter_contig_chunks(assembly.id, columns, chunk_size):
+            names = [row[1] for row in rows]
+            name_field = ('name', 'U{}'.format(max(1, *map(len, names))))
+            chunk = np.zeros(len(rows), [name_field] + fields)
+            chunk['name'] = names
+            chunk['length'] = [row[2] for row in rows]
+            chunk['gc'] = [row[3] for row in rows]
+            chunk['end'] = [record.end for record in islice(records, len(rows))]
+            if calculate_fourmers:
+                chunk['fourmers'] = np.frombuffer(b''.join(row[4] for row in rows),
+                                                  dtype=np.float32).reshape(-1, 4 ** 4)
+                chunk['pcs'] = [row[5:8] for row in rows]
+            np.save(f, chunk)
+    os.replace(f.name, path)
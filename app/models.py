@@ -1,8 +1,8 @@
-import json
-from collections import Counter
+import os
+from functools import lru_cache
 
+import numpy as np
 from sqlalchemy.orm import Load
-from sqlalchemy import func
 
 from app import db, utils, app
 
@@ -17,6 +17,9 @@ gencontig = db.Table('gencontig',
                      db.Column('contig_id', db.Integer, db.ForeignKey('contig.id')))
 
 
+CHUNK_SIZE = 10000
+
+
 class FastaMixin:
     def save_fa(self, path):
         with open(path, 'w') as f:
@@ -36,6 +39,15 @@ class Bin(db.Model, FastaMixin):
     contamination = db.Column(db.Float)
     completeness = db.Column(db.Float)
     unbinned = db.Column(db.Boolean, default=False)
+    # Kept up to date by add_contigs and remove_contigs: the contig count,
+    # total length, length weighted gc sum, count per essential gene in the
+    # order of essential_gene_index and the length histogram, see
+    # utils.add_lengths, that n50 is calculated from.
+    contig_count = db.Column(db.Integer, default=0)
+    total_bp = db.Column(db.BigInteger, default=0)
+    gc_sum = db.Column(db.Float, default=0)
+    gene_counts = db.deferred(db.Column(db.LargeBinary))
+    length_counts = db.deferred(db.Column(db.LargeBinary))
 
     # contigs = db.relationship('Contig', secondary=bincontig, lazy='dynamic',
     #                           backref=db.backref('bins'), viewonly=True)
@@ -43,29 +55,95 @@ class Bin(db.Model, FastaMixin):
                               backref=db.backref('bins'))
     contigs_eager = db.relationship('Contig', secondary=bincontig)
 
+    def add_contigs(self, contigs):
+        """
+        :param contigs: Contigs that are not in the bin yet. The bin must
+            have been flushed.
+        """
+        links = [{'bin_id': self.id, 'contig_id': c.id} for c in contigs]
+        if links:
+            db.session.execute(bincontig.insert(), links)
+        self._update_aggregates(contigs, 1)
+
+    def remove_contigs(self, contigs):
+        """
+        :param contigs: Contigs that are in the bin.
+        """
+        ids = [c.id for c in contigs]
+        for i in range(0, len(ids), CHUNK_SIZE):
+            db.session.execute(bincontig.delete().where(db.and_(
+                bincontig.c.bin_id == self.id,
+                bincontig.c.contig_id.in_(ids[i:i + CHUNK_SIZE]))))
+        self._update_aggregates(contigs, -1)
+
+    def recount(self):
+        """
+        Calculate the aggregates from all contigs of the bin.
+        """
+        self.contig_count = self.total_bp = self.gc_sum = self.n50 = 0
+        self.gene_counts = self.length_counts = None
+        contigs = self.contigs.options(db.load_only('id', 'length', 'gc')).all()
+        self._update_aggregates(contigs, 1)
+
+    def _update_aggregates(self, contigs, sign):
+        if not contigs:
+            return
+        # The row is locked and the sums are updated in SQL, so that
+        # concurrent moves add up instead of overwriting each other.
+        table = Bin.__table__
+        gene_counts, length_counts = db.session.query(Bin.gene_counts, Bin.length_counts). \
+            filter(Bin.id == self.id). \
+            with_for_update(). \
+            one()
+        markers = marker_matrix(self.bin_set.assembly)
+        gene_counts = self._gene_count_vector(gene_counts) + \
+            sign * markers.gene_counts([c.id for c in contigs])
+        length_counts = utils.add_lengths(self._length_count_rows(length_counts),
+                                          [c.length for c in contigs], sign)
+        db.session.execute(table.update().where(table.c.id == self.id).values(
+            contig_count=db.func.coalesce(table.c.contig_count, 0) + sign * len(contigs),
+            total_bp=db.func.coalesce(table.c.total_bp, 0) +
+            sign * sum(c.length for c in contigs),
+            gc_sum=db.func.coalesce(table.c.gc_sum, 0) +
+            sign * sum(c.gc * c.length for c in contigs),
+            gene_counts=gene_counts.astype(np.int32).tobytes(),
+            length_counts=length_counts.tobytes(),
+            n50=utils.n50(*length_counts.T)))
+        db.session.expire(self, ['contig_count', 'total_bp', 'gc_sum', 'gene_counts',
+                                 'length_counts', 'n50'])
+
+    def gene_count_vector(self):
+        """
+        :return: Count per essential gene of the contigs in the bin.
+        """
+        return self._gene_count_vector(self.gene_counts)
+
+    @staticmethod
+    def _gene_count_vector(gene_counts):
+        if gene_counts is None:
+            return np.zeros(len(essential_gene_index()), dtype=np.int32)
+        return np.frombuffer(gene_counts, dtype=np.int32)
+
+    @staticmethod
+    def _length_count_rows(length_counts):
+        return np.frombuffer(length_counts or b'', dtype=np.int64).reshape(-1, 2)
+
     def recalculate_values(self):
-        self.gc = utils.gc_content_bin(self)
-        self.n50 = utils.n50(self)
+        self.gc = utils.gc_content_sum(self.gc_sum, self.total_bp)
         if self.bin_set.assembly.genes_searched:
             self.calculate_cont_comp()
 
     def calculate_cont_comp(self):
-        all_genes = [gene.name for contig in self.contigs for gene in contig.essential_genes]
-        gene_count = Counter(all_genes)
-        contaminated_count = len([gene for gene, count in gene_count.items() if count > 1])
-        total_reference = EssentialGene.query.filter_by(source='essential').count()
-        self.completeness = round(len(gene_count) / total_reference, 4)
-        self.contamination = round(contaminated_count / total_reference, 4)
+        self.completeness, self.contamination = \
+            utils.completeness_contamination(self.gene_count_vector())
 
     @property
     def size(self):
-        return self.contigs.count()
+        return self.contig_count
 
     @property
     def bp(self):
-        if self.size == 0:
-            return 0
-        return self.contigs.with_entities(func.sum(Contig.length)).scalar()
+        return self.total_bp
         
     def to_dict(self):
         return {
@@ -92,16 +170,21 @@ class Contig(db.Model):
     pc_1 = db.Column(db.Float)
     pc_2 = db.Column(db.Float)
     pc_3 = db.Column(db.Float)
-    fourmerfreqs = db.Column(db.String)
+    # Packed float32 vectors, see utils.pack_floats.
+    fourmers = db.Column(db.LargeBinary)
     assembly_id = db.Column(db.Integer, db.ForeignKey('assembly.id'),
                             nullable=False)
-    coverage = db.Column(db.String, default='{}')
+    # Coverage per sample, in the order of Assembly.coverage_samples.
+    coverage_values = db.Column(db.LargeBinary)
     essential_genes = db.relationship('EssentialGene', secondary=gencontig, 
                                       lazy='dynamic', backref=db.backref('contigs'))
     
     @property
     def coverages(self):
-        return {sample: float(cov) for sample, cov in json.loads(self.coverage).items()}
+        if self.coverage_values is None:
+            return {}
+        values = utils.packed_matrix([self.coverage_values], len(self.assembly.coverage_samples))
+        return dict(zip(self.assembly.coverage_samples, utils.float32_values(values[0])))
 
 
 class BinSet(db.Model):
@@ -119,8 +202,9 @@ class BinSet(db.Model):
         return self.bins.filter_by(unbinned=False)
         
     def to_dict(self):
-        bins = self.bins.options(db.load_only('id', 'color'))
-        bins = sorted(bins, key=lambda x: x.size, reverse=True)
+        bins = self.bins.options(db.load_only('id', 'color', 'contig_count')). \
+            order_by(Bin.contig_count.desc()). \
+            all()
         sum_ = sum([b.size for b in bins])
         return {
             'id': self.id,
@@ -147,20 +231,57 @@ class Assembly(db.Model, FastaMixin):
     busy = db.Column(db.Boolean, default=False)
     demo = db.Column(db.Boolean, default=False)
     samples = db.Column(db.String)
+    # Ingestion checkpoints: the fasta offset up to which contigs are saved
+    # and the stages that are done.
+    ingest_offset = db.Column(db.BigInteger, default=0)
+    genes_done = db.Column(db.Boolean, default=False)
+    pca_done = db.Column(db.Boolean, default=False)
+    # Hash of the uploaded fasta, the key of its features in the cache.
+    content_hash = db.Column(db.String(64))
     contigs = db.relationship('Contig', backref='assembly', lazy='dynamic',
                               cascade='all, delete')
     bin_sets = db.relationship('BinSet', backref='assembly', lazy='dynamic',
                                cascade='all, delete')
                                
+    @property
+    def size(self):
+        """
+        Number of contigs, cached once the assembly is saved.
+        """
+        if self.busy:
+            return self.contigs.count()
+        return _contig_count(self.id, self.submit_date)
+
+    @property
+    def fasta_path(self):
+        path = os.path.join(app.config['BASEDIR'], 'data/assemblies',
+                            '{}.fa'.format(1 if self.demo else self.id))
+        return path if os.path.exists(path) else path + '.gz'
+
     @property
     def coverage_samples(self):
         return [] if self.samples is None else self.samples.split(',')
+
+    def coverage_matrix(self, contigs=None):
+        """
+        :param contigs: Contig query to take the coverages of, defaults to
+            all contigs of the assembly.
+        :return: Array of contig ids and a contig x sample float32 matrix,
+            ordered by id. Contigs without coverage have NaN rows.
+        """
+        contigs = self.contigs if contigs is None else contigs
+        rows = contigs.with_entities(Contig.id, Contig.coverage_values). \
+            order_by(Contig.id). \
+            all()
+        ids = np.array([id for id, _ in rows], dtype=np.int64)
+        matrix = utils.packed_matrix((values for _, values in rows), len(self.coverage_samples))
+        return ids, matrix
         
     def to_dict(self):
         return {
             'id': self.id,
             'name': self.name,
-            'size': self.contigs.count(),
+            'size': self.size,
             'hasFourmerfreqs': self.has_fourmerfreqs,
             'genesSearched': self.genes_searched,
             'binSets': self.bin_sets.count(),
@@ -174,3 +295,62 @@ class EssentialGene(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
     source = db.Column(db.String(50), nullable=False)
+
+
+def essential_gene_index():
+    """
+    :return: Dict essential gene id -> position in gene count vectors.
+    """
+    ids = db.session.query(EssentialGene.id). \
+        filter_by(source='essential'). \
+        order_by(EssentialGene.id)
+    return {id: i for i, (id,) in enumerate(ids)}
+
+
+class MarkerMatrix:
+    """
+    Sparse contig x essential gene matrix of an assembly: the contig id and
+    gene position of every essential gene hit, sorted by contig id.
+    """
+    def __init__(self, assembly_id):
+        index = essential_gene_index()
+        hits = db.session.query(gencontig.c.contig_id, gencontig.c.gene_id). \
+            join(Contig, Contig.id == gencontig.c.contig_id). \
+            filter(Contig.assembly_id == assembly_id). \
+            all()
+        hits = np.array([(contig_id, index[gene_id]) for contig_id, gene_id in hits
+                         if gene_id in index], dtype=np.int64).reshape(-1, 2)
+        hits = hits[np.argsort(hits[:, 0], kind='stable')]
+        self.contig_ids = hits[:, 0]
+        self.genes = hits[:, 1]
+        self.num_genes = len(index)
+
+    def gene_counts(self, contig_ids):
+        """
+        :return: Vector with the count per essential gene of the contigs.
+        """
+        contig_ids = np.asarray(contig_ids, dtype=np.int64)
+        starts = np.searchsorted(self.contig_ids, contig_ids, 'left')
+        lengths = np.searchsorted(self.contig_ids, contig_ids, 'right') - starts
+        # Positions of the hits of all contigs, from their ranges.
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(lengths.sum())
+        return np.bincount(self.genes[positions], minlength=self.num_genes).astype(np.int32)
+
+
+def marker_matrix(assembly):
+    """
+    :return: The MarkerMatrix of the assembly, cached once its genes are
+        searched.
+    """
+    return _marker_matrix(assembly.id, assembly.submit_date, assembly.genes_done)
+
+
+@lru_cache(maxsize=8)
+def _marker_matrix(assembly_id, submit_date, genes_done):
+    return MarkerMatrix(assembly_id)
+
+
+@lru_cache(maxsize=128)
+def _contig_count(assembly_id, submit_date):
+    return Contig.query.filter_by(assembly_id=assembly_id).count()
@@ -1,70 +1,137 @@
 import tempfile
 import os
 import uuid
-import json
-from itertools import product
-from collections import Counter
+import gzip
+import shutil
+import threading
 from datetime import datetime
-from subprocess import call
+from subprocess import Popen, CalledProcessError, DEVNULL
+from collections import deque, defaultdict
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import werkzeug
 from flask import session, abort, request
 from flask_restful import Resource, reqparse
 from rq import get_current_job
 
-from app import db, utils, app, q
-from app.models import Contig, Assembly, EssentialGene
+from app import db, utils, fasta, bgzf, bulk, feature_cache, tiles, app, q
+from app.models import Assembly
+from app.resources.contigs_tiles import enqueue_tiles_job
 
 
-def save_contigs(assembly, fasta_filename, calculate_fourmers, essential_genes=None, 
-                 bulk_size=5000, coverages=None):
+def iter_contig_features(fasta_filename, calculate_fourmers, processes=1,
+                         shard_size=16 * 1024 * 1024, start=0):
+    """
+    :param processes: Number of processes to compute the features with.
+    :param shard_size: Size in bytes of the fasta chunks handed to a process.
+    :param start: Byte offset in the fasta file to start at.
+    :return: Generator of ContigFeatures in fasta order.
+    """
+    if processes <= 1:
+        yield from utils.contig_features(fasta_filename, calculate_fourmers, start)
+        return
+    with ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        for start, end in fasta.fasta_shards(fasta_filename, shard_size, start):
+            pending.append(executor.submit(_shard_features, fasta_filename,
+                                           calculate_fourmers, start, end))
+            # Bound the shards in flight, so that computed features do not
+            # pile up while the parent is writing to the database.
+            if len(pending) > 2 * processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _shard_features(fasta_filename, calculate_fourmers, start, end):
+    return list(utils.contig_features(fasta_filename, calculate_fourmers, start, end))
+
+
+def save_contigs(assembly, fasta_filename, calculate_fourmers, bulk_size=20000,
+                 coverages=None, processes=1, cached=None):
     """
     :param assembly: A Assembly model object in which to save the contigs.
     :param fasta_filename: The file name of the fasta file where the contigs are stored.
     :param bulk_size: How many contigs to store per bulk.
+    :param coverages: A CoverageJoiner over the coverage file.
+    :param processes: How many processes compute the contig features.
+    :param cached: Content hash of the assembly, to read the contig features
+        from the feature cache instead of computing them.
+    :return: The contigs without coverage and the insert rate in rows/s.
+
+    Contigs are read from `assembly.ingest_offset` on, which is moved past
+    the contigs of every committed bulk. An interrupted ingestion so
+    resumes after the last committed contig.
     """
+    start = end = assembly.ingest_offset or 0
+    if coverages is not None and start > 0:
+        coverages.resume(bulk.iter_contig_chunks(
+            assembly.id, ['name', 'coverage_values'], bulk_size))
+
+    def rows():
+        nonlocal end
+        if cached is not None:
+            contigs = feature_cache.iter_rows(cached, calculate_fourmers)
+        else:
+            features = iter_contig_features(fasta_filename, calculate_fourmers, processes,
+                                            start=start)
+            contigs = ((f.end, {'name': f.name, 'length': f.length, 'gc': f.gc,
+                                'fourmers': f.fourmers})
+                       for f in features)
+        for end, row in contigs:
+            row['coverage_values'] = None if coverages is None else coverages.pop(row['name'])
+            yield row
+
+    def checkpoint():
+        assembly.ingest_offset = end
+
+    _, rate = bulk.insert_contigs(assembly.id, rows(), bulk_size, checkpoint)
     notfound = []
-    fourmers = [''.join(fourmer) for fourmer in product('atcg', repeat=4)]
-    if essential_genes is not None:
-        all_genes = EssentialGene.query.filter_by(source='essential').all()
-        all_genes = {gene.name: gene for gene in all_genes}
-    for i, data in enumerate(utils.parse_fasta(fasta_filename), 1):
-        name, sequence = data
-        name = name.split(' ')[0]
-        sequence = sequence.lower()
-        contig = Contig(name=name, length=len(sequence),
-                        gc=utils.gc_content(sequence), 
-                        assembly=assembly)
-        if coverages is not None:
-            try:
-                coverage = coverages.pop(name)
-                contig.coverage = '{}' if coverage is None else json.dumps(coverage)
-            except KeyError:
-                notfound.append(name)
-        if essential_genes is not None:
-            for gene in essential_genes[name]:
-                all_genes[gene].contigs.append(contig)
-        if calculate_fourmers:
-            fourmer_count = len(sequence) - 4 + 1
-            counts = Counter([sequence[k:k+4] for k in range(fourmer_count)])
-            frequencies = ','.join([str(counts[fourmer] / fourmer_count) for fourmer in fourmers])
-            contig.fourmerfreqs = frequencies
-        db.session.add(contig)
-        if i % bulk_size == 0:
-            app.logger.debug('At: ' + str(i))
-            db.session.flush()
-    db.session.commit()
-    if calculate_fourmers:
-        pcs = utils.pca_fourmerfreqs(assembly.contigs)
-        for i, contig in enumerate(assembly.contigs): # TODO: load nothing?
-            contig.pc_1, contig.pc_2, contig.pc_3 = pcs[i]
-    db.session.commit()
-    return notfound
+    if coverages is not None:
+        # Coverages that were too far ahead in the file for their contig.
+        late = coverages.deferred_coverages()
+        if late:
+            for chunk in bulk.iter_contig_chunks(assembly.id, ['name'], bulk_size):
+                bulk.update_contigs([{'_id': id, 'coverage_values': late[name]}
+                                     for id, name in chunk if name in late])
+            db.session.commit()
+        notfound = [name for name in coverages.deferred if name not in late]
+    if cached is not None and calculate_fourmers:
+        # The cached rows hold the principal components.
+        assembly.pca_done = True
+        db.session.commit()
+    if calculate_fourmers and not assembly.pca_done:
+        save_principal_components(assembly, bulk_size)
+        assembly.pca_done = True
+        db.session.commit()
+    return notfound, rate
+
+
+def save_principal_components(assembly, chunk_size=20000):
+    """
+    Calculate the first three principal components of the fourmer
+    frequencies of all contigs in the assembly. The data is read twice in
+    chunks: once to accumulate the covariance and once to project.
+    """
+    pca = utils.StreamingPCA(4 ** 4, 3)
+    for rows in bulk.iter_contig_chunks(assembly.id, ['fourmers'], chunk_size):
+        pca.update(utils.packed_matrix((fourmers for _, fourmers in rows), 4 ** 4))
+    if pca.count == 0:
+        return
+    for rows in bulk.iter_contig_chunks(assembly.id, ['fourmers'], chunk_size):
+        pcs = pca.transform(utils.packed_matrix((fourmers for _, fourmers in rows), 4 ** 4))
+        bulk.update_contigs([{'_id': id, 'pc_1': pc_1, 'pc_2': pc_2, 'pc_3': pc_3}
+                             for (id, _), (pc_1, pc_2, pc_3) in zip(rows, pcs.tolist())])
+        db.session.commit()
 
 
 def read_coverages(filename):
+    """
+    :return: The sample names and a generator of (contig name, coverage per
+        sample packed by `utils.pack_floats`) in file order.
+    """
     coverage_file = utils.parse_dsv(filename)
-    coverages = {}
 
     # Determine if the file has a header.
     fields = next(coverage_file)
@@ -73,72 +140,266 @@ def read_coverages(filename):
         samples = fields[1:]
     else:
         samples = ['sample_{}'.format(i) for i, _ in enumerate(fields[1:], 1)]
-        contig_name, *_coverages = fields
-        coverages[contig_name] = {samples[i]: _coverages[i] for i, _ in enumerate(samples)}
+        coverage_file = chain([fields], coverage_file)
 
-    for contig_name, *_coverages in coverage_file:
-        coverages[contig_name] = {samples[i]: _coverages[i] for i, _ in enumerate(samples)}
+    rows = ((contig_name, utils.pack_floats(_coverages[:len(samples)]))
+            for contig_name, *_coverages in coverage_file)
+    return samples, rows
 
-    os.remove(filename)
-    return samples, coverages
 
-    
-def find_essential_genes_per_contig(assembly_path):
+class CoverageJoiner:
+    """
+    Join streamed coverage rows to the contigs in fasta order. Rows read
+    ahead of the contig asked for are kept until they are asked for. A
+    contig not found within `window` rows is deferred and matched against
+    the rest of the file once all contigs are saved. A coverage file in
+    (about) fasta order is so joined in bounded memory.
+    """
+    def __init__(self, rows, window):
+        self.rows = iter(rows)
+        self.window = window
+        self.pending = {}
+        self.deferred = {}
+        self.skip = set()
+
+    def resume(self, contigs):
+        """
+        Account for contigs saved before ingestion was interrupted: rows of
+        contigs that have their coverage are skipped, contigs without are
+        deferred.
+
+        :param contigs: Chunks of (id, name, coverage_values) rows.
+        """
+        for chunk in contigs:
+            for _, name, coverage in chunk:
+                if coverage is None:
+                    self.deferred[name] = None
+                else:
+                    self.skip.add(name)
+
+    def pop(self, name):
+        if name in self.pending:
+            return self.pending.pop(name)
+        for row_name, coverage in islice(self.rows, self.window):
+            if row_name in self.skip:
+                continue
+            if row_name == name:
+                return coverage
+            self.pending[row_name] = coverage
+        self.deferred[name] = None
+        return None
+
+    def deferred_coverages(self):
+        """
+        :return: Dict contig name -> coverage for the deferred contigs
+            found in the rest of the file.
+        """
+        if not self.deferred:
+            return {}
+        rows = chain(self.pending.items(), self.rows)
+        return {name: coverage for name, coverage in rows if name in self.deferred}
+
+
+class Subprocesses:
+    """
+    Runs subprocesses from several threads, so that they can all be
+    terminated at once by another thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = []
+        self.terminated = False
+
+    def check_call(self, args, **kwargs):
+        """
+        Like `subprocess.check_call`, failing right away after `terminate`.
+        """
+        with self.lock:
+            if self.terminated:
+                raise CalledProcessError(-15, args)
+            process = Popen(args, **kwargs)
+            self.running.append(process)
+        try:
+            returncode = process.wait()
+        finally:
+            with self.lock:
+                self.running.remove(process)
+        if returncode:
+            raise CalledProcessError(returncode, args)
+
+    def terminate(self):
+        with self.lock:
+            self.terminated = True
+            running = list(self.running)
+        for process in running:
+            process.terminate()
+        for process in running:
+            process.wait()
+
+
+def find_essential_genes_per_contig(assembly_path, processes=1, subprocesses=None):
     """
     :param assembly_path: Fasta file with the assembly contigs.
-    1. Run prodigal to predict genes. 
-    2. Run Hmmer to find out which of these genes are essential.
-    3. Return # essential genes per contig.
+    :param processes: In how many shards to split the assembly.
+    :param subprocesses: Subprocesses to run prodigal and hmmsearch with.
+    1. Split the assembly in shards of about equal size.
+    2. Run prodigal on every shard to predict genes. 
+    3. Run Hmmer on every shard to find out which of these genes are essential.
+    4. Return # essential genes per contig from the merged Hmmer tables.
     """
+    if subprocesses is None:
+        subprocesses = Subprocesses()
     with tempfile.TemporaryDirectory() as dirname:
-        # Prodigal
-        proteins_path = os.path.join(dirname, 'proteins.faa')
-        prodigal_path = os.path.join(dirname, 'prodigal.txt') 
-        returncode = call(['prodigal', 
-            '-p', 'meta',          # Metagenomics mode
-            '-q',                  # Sssht
-            '-a', proteins_path,   # Protein-coded predicted genes
-            '-i', assembly_path,   # Assembly file (input)
-            '-o', prodigal_path])  # Output
-        # Hmmer
-        model_path = 'data/essential.hmm'
+        # Prodigal reads plain fasta files only.
+        if processes > 1 or bgzf.is_gzip(assembly_path):
+            shard_paths = fasta.split_fasta(assembly_path, dirname, processes)
+        else:
+            shard_paths = [assembly_path]
+        with ThreadPoolExecutor(processes) as executor:
+            orfs_paths = list(executor.map(_search_essential_genes,
+                                           [subprocesses] * len(shard_paths), shard_paths,
+                                           [dirname] * len(shard_paths),
+                                           range(len(shard_paths)),
+                                           [processes > 1] * len(shard_paths)))
         orfs_path = os.path.join(dirname, 'orfs.txt')
-        returncode = call(['hmmsearch', 
-            '--tblout', orfs_path,
-            '--cut_tc', '--notextw',
-            model_path, proteins_path],
-            stdout=open(os.devnull, 'wb'))
-
+        with open(orfs_path, 'wb') as f:
+            for path in orfs_paths:
+                with open(path, 'rb') as shard_f:
+                    shutil.copyfileobj(shard_f, f)
         return utils.parse_hmmsearch_table(orfs_path)
 
 
+def _search_essential_genes(subprocesses, assembly_path, dirname, shard, sharded=False):
+    # Prodigal
+    proteins_path = os.path.join(dirname, 'proteins_{}.faa'.format(shard))
+    prodigal_path = os.path.join(dirname, 'prodigal_{}.txt'.format(shard))
+    subprocesses.check_call([app.config['PRODIGAL'],
+        '-p', 'meta',          # Metagenomics mode
+        '-q',                  # Sssht
+        '-a', proteins_path,   # Protein-coded predicted genes
+        '-i', assembly_path,   # Assembly file (input)
+        '-o', prodigal_path])  # Output
+    # Hmmer
+    model_path = 'data/essential.hmm'
+    orfs_path = os.path.join(dirname, 'orfs_{}.txt'.format(shard))
+    # Shards run side by side, a single search uses the default threads.
+    cpu = ['--cpu', '1'] if sharded else []
+    subprocesses.check_call([app.config['HMMSEARCH'],
+        '--tblout', orfs_path,
+        '--cut_tc', '--notextw',
+        *cpu,
+        model_path, proteins_path],
+        stdout=DEVNULL)
+    return orfs_path
+
+
+def load_or_find_essential_genes(assembly_path, genes_path, processes=1, subprocesses=None):
+    """
+    Find the essential genes per contig, or load them from `genes_path`
+    if a previous run of the job already found them.
+    """
+    if os.path.exists(genes_path):
+        essential_genes = defaultdict(list)
+        for contig, gene in utils.parse_dsv(genes_path, '\t'):
+            essential_genes[contig].append(gene)
+        return essential_genes
+    essential_genes = find_essential_genes_per_contig(assembly_path, processes, subprocesses)
+    # Concurrent uploads of the same file share the path, so the genes are
+    # written to a temporary file first.
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(genes_path),
+                                     suffix='.tsv.tmp', delete=False) as f:
+        for contig, genes in essential_genes.items():
+            for gene in genes:
+                f.write('{}\t{}\n'.format(contig, gene))
+    os.replace(f.name, genes_path)
+    return essential_genes
+
+
 def save_assembly_job(assembly, fasta_path, calculate_fourmers,
                       search_genes, email=None, 
-                      coverage_filename=None, bulk_size=5000):
+                      coverage_filename=None, bulk_size=None, processes=None):
+    """
+    Save the contigs of an uploaded assembly. The job keeps checkpoints on
+    the assembly, so that when it is run again after being interrupted it
+    resumes instead of starting over.
+    """
     job = get_current_job()
+    if bulk_size is None:
+        bulk_size = app.config['INGEST_BATCH_SIZE']
+    if processes is None:
+        processes = app.config['INGEST_PROCESSES']
+    # The pickled assembly holds the state of when the job was enqueued.
+    assembly = Assembly.query.get(assembly.id)
+    resumed = bool(assembly.ingest_offset)
+    content_hash = assembly.content_hash
+    # Features of an assembly uploaded before are reused, unless the job
+    # resumes after it started computing them.
+    cached = None
+    if content_hash is not None and not resumed and \
+            feature_cache.has_features(content_hash, calculate_fourmers):
+        cached = content_hash
+    if content_hash is not None:
+        genes_path = feature_cache.cache_path(content_hash, 'genes.tsv')
+        os.makedirs(os.path.dirname(genes_path), exist_ok=True)
+    else:
+        genes_path = os.path.join(os.path.dirname(fasta_path),
+                                  '{}.genes.tsv'.format(assembly.id))
+
+    # Find essential genes in the background, the contigs do not depend on
+    # them. The prodigal and hmmsearch subprocesses do the work.
+    executor = ThreadPoolExecutor(1)
+    subprocesses = Subprocesses()
+    gene_search = None
+    try:
+        if search_genes and not assembly.genes_done:
+            gene_search = executor.submit(load_or_find_essential_genes, fasta_path,
+                                          genes_path, app.config['GENE_SEARCH_PROCESSES'],
+                                          subprocesses)
 
-    # Find essential genes
-    essential_genes = None
-    if search_genes:
-        job.meta['status'] = 'Searching for essential genes per contig'
+        # Save contigs to database
+        job.meta['status'] = 'Saving contigs'
         job.save()
-        essential_genes = find_essential_genes_per_contig(fasta_path)
-
-    # Save contigs to database
-    job.meta['status'] = 'Saving contigs'
-    job.save()
-    args = [assembly, fasta_path, calculate_fourmers, essential_genes, bulk_size]
-    if coverage_filename is not None:
-        samples, coverages = read_coverages(coverage_filename)
-        args.append(coverages)
-        assembly.samples = ','.join(samples)
-    notfound = save_contigs(*args)
-    job.meta['notfound'].extend(notfound)
-    job.save()
+        if not os.path.exists(fasta_path + '.fai'):
+            fasta.write_index(fasta_path)
+        coverages = None
+        if coverage_filename is not None:
+            samples, rows = read_coverages(coverage_filename)
+            coverages = CoverageJoiner(rows, bulk_size)
+            assembly.samples = ','.join(samples)
+        notfound, rate = save_contigs(assembly, fasta_path, calculate_fourmers, bulk_size,
+                                      coverages, processes, cached)
+        job.meta['notfound'].extend(notfound)
+        job.meta['rate'] = round(rate)
+        job.save()
+
+        # Link the essential genes to the saved contigs
+        if gene_search is not None:
+            job.meta['status'] = 'Searching for essential genes per contig'
+            job.save()
+            essential_genes = gene_search.result()
+            if resumed:
+                bulk.unlink_essential_genes(assembly.id)
+            bulk.link_essential_genes(assembly.id, essential_genes, bulk_size)
+            assembly.genes_done = True
+            db.session.commit()
+    except BaseException:
+        # Fail right away instead of after the gene search is done. The
+        # search fails as soon as its tools are terminated, which removes
+        # its temporary directory.
+        subprocesses.terminate()
+        executor.shutdown()
+        raise
+    executor.shutdown()
 
+    if content_hash is not None:
+        feature_cache.save_features(content_hash, assembly, fasta_path, bulk_size)
     assembly.busy = False
-    db.session.add(assembly)
     db.session.commit()
+    for x_axis, y_axis in tiles.default_axes(assembly):
+        enqueue_tiles_job(assembly, x_axis, y_axis)
+    for path in (coverage_filename, None if content_hash else genes_path):
+        if path is not None and os.path.exists(path):
+            os.remove(path)
 
     if email:
         utils.send_completion_email(email, assembly.name)
@@ -146,6 +407,42 @@ def save_assembly_job(assembly, fasta_path, calculate_fourmers,
     return {'assembly': assembly.id}
     
 
+def save_fasta_upload(upload, path):
+    """
+    Save an uploaded fasta file, that may be gzip or bgzip compressed, at
+    `path`. Compressed uploads are decompressed while they are written.
+    With STORE_COMPRESSED the file is instead stored bgzip compressed, with
+    a block index, at `path` + '.gz'.
+    :return: The path of the saved file and the sha256 hash of the
+        uncompressed contents.
+    """
+    header = upload.stream.read(18)
+    upload.stream.seek(0)
+    compressed = header[:2] == bgzf.GZIP_MAGIC
+    if app.config['STORE_COMPRESSED']:
+        path += '.gz'
+        if bgzf.is_bgzf_header(header):
+            upload.save(path)
+            bgzf.write_index(path, *bgzf.build_index(path))
+            upload.stream.seek(0)
+            return path, feature_cache.copy_hashed(gzip.GzipFile(fileobj=upload.stream))
+    source = gzip.GzipFile(fileobj=upload.stream) if compressed else upload.stream
+    with (bgzf.BgzfWriter(path) if app.config['STORE_COMPRESSED'] else open(path, 'wb')) as f:
+        content_hash = feature_cache.copy_hashed(source, f)
+    return path, content_hash
+
+
+def enqueue_assembly_job(assembly, fasta_path, coverage_path=None):
+    job_args = [assembly, fasta_path, assembly.has_fourmerfreqs, assembly.genes_searched,
+                assembly.email]
+    job_meta = {'name': assembly.name, 'status': 'pending', 'type': 'A', 'notfound': []}
+    if coverage_path is not None:
+        job_args.append(coverage_path)
+    job = q.enqueue(save_assembly_job, args=job_args, meta=job_meta,
+                    timeout=60*60*24)
+    return job, job_meta
+
+
 class AssembliesApi(Resource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
@@ -203,21 +500,21 @@ class AssembliesApi(Resource):
         fasta_path = os.path.join(app.config['BASEDIR'], 
                                   'data/assemblies', 
                                   '{}.fa'.format(assembly.id))
-        with open(fasta_path, 'wb') as f:
-            args.contigs.save(f)
+        fasta_path, assembly.content_hash = save_fasta_upload(args.contigs, fasta_path)
+        db.session.commit()
 
+        # Kept next to the assembly until the job is done, so that an
+        # interrupted job can be resumed.
+        coverage_path = None
         if args.coverage.filename != '':
-            coverage_file = tempfile.NamedTemporaryFile(delete=False)
-            args.coverage.save(coverage_file)
-            coverage_file.close()
+            coverage_path = os.path.join(app.config['BASEDIR'],
+                                         'data/assemblies',
+                                         '{}.coverage'.format(assembly.id))
+            with open(coverage_path, 'wb') as f:
+                args.coverage.save(f)
             
         # Send job
-        job_args = [assembly, fasta_path, args.fourmers, args.hmmer, args.email]
-        job_meta = {'name': name, 'status': 'pending', 'type': 'A', 'notfound': []}
-        if args.coverage.filename != '':
-            job_args.append(coverage_file.name)
-        job = q.enqueue(save_assembly_job, args=job_args, meta=job_meta,
-                        timeout=60*60*24)
+        job, job_meta = enqueue_assembly_job(assembly, fasta_path, coverage_path)
         session['jobs'].append(job.id)
 
         return job_meta, 202, {'Location': '/jobs/{}'.format(job.id)}
@@ -1,7 +1,7 @@
 from flask_restful import Resource, reqparse
 
 from .utils import user_assembly_or_404
-from app import db
+from app import db, tiles
 
 
 class AssemblyApi(Resource):
@@ -28,4 +28,5 @@ class AssemblyApi(Resource):
         assembly = user_assembly_or_404(id)
         db.session.delete(assembly)
         db.session.commit()
+        tiles.remove(id)
 
@@ -1,10 +1,24 @@
-from collections import Counter
+from collections import defaultdict
 
+import numpy as np
 from flask_restful import Resource, reqparse
 
 from .utils import bin_set_or_404
-from app import db, app
-from app.models import Contig, EssentialGene
+from app import db, utils, app
+from app.models import bincontig, marker_matrix
+
+
+def refine_contigs_per_bin(bins, contig_ids):
+    """
+    :return: Dict bin id -> the given contigs that are in the bin.
+    """
+    in_bins = defaultdict(list)
+    links = db.session.query(bincontig.c.bin_id, bincontig.c.contig_id). \
+        filter(bincontig.c.bin_id.in_([bin.id for bin in bins]),
+               bincontig.c.contig_id.in_(contig_ids))
+    for bin_id, contig_id in links:
+        in_bins[bin_id].append(contig_id)
+    return in_bins
 
 
 class AssessApi(Resource):
@@ -19,30 +33,69 @@ class AssessApi(Resource):
         bin_set = bin_set_or_404(assembly_id, id)
         args = self.reqparse.parse_args()
         refine_contigs_ids = set(args.contigs)
-        refine_contigs = bin_set.assembly.contigs. \
-            filter(Contig.id.in_(refine_contigs_ids)). \
-            all()
-        bins = []
-        for bin in bin_set.bins.options(db.lazyload('contigs_eager')).all():
-            contigs = bin.contigs.all()
+        markers = marker_matrix(bin_set.assembly)
+        bins = bin_set.bins.options(db.undefer('gene_counts')).all()
 
+        in_bins = refine_contigs_per_bin(bins, refine_contigs_ids)
+
+        result = []
+        for bin in bins:
             if bin.id == args.to_bin:
-                contigs.extend(refine_contigs)
-            elif len(refine_contigs_ids.intersection([contig.id for contig in contigs])) > 0:
-                contigs = [contig for contig in contigs if contig.id not in refine_contigs_ids]
+                added = refine_contigs_ids.difference(in_bins[bin.id])
+                gene_counts = bin.gene_count_vector() + markers.gene_counts(sorted(added))
+            elif in_bins[bin.id]:
+                gene_counts = bin.gene_count_vector() - markers.gene_counts(in_bins[bin.id])
             else:
                 continue
-            
-            all_genes = [gene.name for contig in contigs for gene in contig.essential_genes]
-            gene_count = Counter(all_genes)
-            contaminated_count = len([gene for gene, count in gene_count.items() if count > 1])
-            total_reference = EssentialGene.query.filter_by(source='essential').count()
-            completeness = round(len(gene_count) / total_reference, 4)
-            contamination = round(contaminated_count / total_reference, 4)
+            completeness, contamination = utils.completeness_contamination(gene_counts)
 
             data = {}
             data['bin'] = {'name': bin.name, 'id': bin.id, 'color': bin.color}
             data['before'] = {'contamination': bin.contamination, 'completeness': bin.completeness}
             data['after'] = {'contamination': contamination, 'completeness': completeness}
-            bins.append(data)
-        return {'bins': bins}
\ No newline at end of file
+            result.append(data)
+        return {'bins': result}
+
+
+class AssessTargetsApi(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('contigs', action='append', type=int, default=[],
+                                    required=True)
+        super(AssessTargetsApi, self).__init__()
+
+    def put(self, assembly_id, id):
+        """
+        Assess every bin as target for moving the contigs to, ranked by the
+        gain in completeness minus contamination of the target.
+        """
+        bin_set = bin_set_or_404(assembly_id, id)
+        args = self.reqparse.parse_args()
+        refine_contigs_ids = set(args.contigs)
+        markers = marker_matrix(bin_set.assembly)
+        bins = bin_set.bins.options(db.undefer('gene_counts')).all()
+        if not bins:
+            return {'bins': []}
+        in_bins = refine_contigs_per_bin(bins, refine_contigs_ids)
+
+        # Bin x gene counts before and after moving the contigs to each bin.
+        before = np.array([bin.gene_count_vector() for bin in bins])
+        moved = np.array([markers.gene_counts(in_bins[bin.id]) for bin in bins])
+        after = before - moved + markers.gene_counts(sorted(refine_contigs_ids))
+        completeness, contamination = utils.completeness_contamination(before)
+        completeness_after, contamination_after = utils.completeness_contamination(after)
+
+        result = []
+        for i, bin in enumerate(bins):
+            gain = (completeness_after[i] - contamination_after[i]) - \
+                (completeness[i] - contamination[i])
+            result.append({
+                'bin': {'name': bin.name, 'id': bin.id, 'color': bin.color,
+                        'unbinned': bin.unbinned},
+                'before': {'contamination': contamination[i], 'completeness': completeness[i]},
+                'after': {'contamination': contamination_after[i],
+                          'completeness': completeness_after[i]},
+                'gain': round(gain, 4)
+            })
+        result.sort(key=lambda data: data['gain'], reverse=True)
+        return {'bins': result}
@@ -1,15 +1,13 @@
-import os
-
 from flask import abort, session, make_response
 from flask_restful import Resource, reqparse
 
 from .utils import bin_or_404
-from app import db, utils, app
+from app import db, utils, fasta, tiles
 from app.models import Bin, Contig
 
 
 def calculate_pcs(bin):
-    cs = bin.contigs.with_entities(Contig.id, Contig.fourmerfreqs).all()
+    cs = bin.contigs.with_entities(Contig.id, Contig.fourmers).all()
     p_components = utils.pca_fourmerfreqs(cs)
     pcs = {}
     for i, contig in enumerate(cs):
@@ -52,12 +50,14 @@ class BinApi(Resource):
         if args.contigs:
             contig_ids = [int(id) for id in args.contigs.split(',')]
             if args.action == 'add':
+                in_bin = bin.contigs.with_entities(Contig.id). \
+                    filter(Contig.id.in_(contig_ids))
                 contigs = bin.bin_set.assembly.contigs. \
-                    filter(Contig.id.in_(contig_ids)). \
+                    filter(Contig.id.in_(contig_ids), ~Contig.id.in_(in_bin)). \
                     all()
-                bin.contigs.extend(contigs)
+                bin.add_contigs(contigs)
             elif args.action == 'remove':
-                bin.contigs = [c for c in bin.contigs if c.id not in contig_ids]
+                bin.remove_contigs(bin.contigs.filter(Contig.id.in_(contig_ids)).all())
             else:
                 contigs = bin.binset.contigset.contigs. \
                     filter(Contig.id.in_(contig_ids)). \
@@ -70,6 +70,8 @@ class BinApi(Resource):
             bin.name = args.name or bin.name
             bin.color = args.color or bin.color
         db.session.commit()
+        if args.contigs or args.color is not None:
+            tiles.invalidate(bin.bin_set)
         
         result = bin.to_dict()
         if args.name is None and bin.contigs.count() > 0:
@@ -85,27 +87,24 @@ class BinApi(Resource):
             return {}, 405
         unbinned = bin_set.bins.filter_by(unbinned=True).first_or_404()
         contigs = bin.contigs.all()
-        bin.contigs = []
-        unbinned.contigs.extend(contigs)
+        bin.remove_contigs(contigs)
+        unbinned.add_contigs(contigs)
         db.session.flush()
         unbinned.recalculate_values()
         db.session.delete(bin)
         db.session.commit()
+        tiles.invalidate(bin_set)
 
 
 class BinExportApi(Resource):
     def get(self, assembly_id, bin_set_id, id):
         bin_set, bin = bin_or_404(assembly_id, bin_set_id, id, return_bin_set=True)
-        if bin_set.assembly.demo:
-            assembly_id = 1
         q = bin.contigs.options(db.load_only('name'))
         contig_names = [c.name for c in q.all()]
-        fasta_path = os.path.join(app.config['BASEDIR'], 
-                                  'data/assemblies', 
-                                  '{}.fa'.format(assembly_id))
-        fasta_string = '\n'.join(['\n'.join((name, sequence))
-                                  for name, sequence in utils.parse_fasta(fasta_path) 
-                                  if name in contig_names])
+        sequences = fasta.read_sequences(bin_set.assembly.fasta_path, contig_names,
+                                         headers=True)
+        fasta_string = ''.join(['>{}\n{}\n'.format(header, sequence.decode())
+                                for header, sequence in sequences])
         response = make_response(fasta_string)
         response.headers['Content-Disposition'] = 'attachment; filename='
         response.headers['Content-Disposition'] += '{}.fa'.format(bin.name)
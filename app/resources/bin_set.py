@@ -1,13 +1,12 @@
-import os
 import io
 import zipfile
 
-from flask import make_response
+from flask import Response, stream_with_context
 from flask_restful import Resource, reqparse
 
 from .utils import bin_set_or_404
-from app import db, app, utils
-from app.models import Contig, Assembly
+from app import db, fasta, tiles
+from app.models import Contig, Bin, Assembly
 
 
 class BinSetApi(Resource):
@@ -31,16 +30,20 @@ class BinSetApi(Resource):
         # Refinement: moving and deleting contigs
         if args.to_bin and len(args.contigs) > 0:
             to_bin = bin_set.bins.filter_by(id=args.to_bin).first_or_404()
-            contigs = bin_set.assembly.contigs. \
-                filter(Contig.id.in_(args.contigs)). \
-                all()
+            moved = []
             for bin in bin_set.bins.options(db.lazyload('contigs_eager')).all():
                 if bin.id == args.to_bin:
-                    bin.contigs.extend(contigs)
-                else:
-                    bin.contigs = [c for c in bin.contigs if c.id not in args.contigs]
-                bin.recalculate_values()
+                    continue
+                contigs = bin.contigs.filter(Contig.id.in_(args.contigs)).all()
+                if contigs:
+                    bin.remove_contigs(contigs)
+                    bin.recalculate_values()
+                    moved.extend(contigs)
+            to_bin.add_contigs(moved)
+            to_bin.recalculate_values()
         db.session.commit()
+        if args.to_bin and len(args.contigs) > 0:
+            tiles.invalidate(bin_set)
 
     def delete(self, assembly_id, id):
         bin_set = bin_set_or_404(assembly_id, id)
@@ -49,39 +52,64 @@ class BinSetApi(Resource):
         for bin in bin_set.bins:
             bin.contigs = []
         db.session.flush()
+        tiles.invalidate(bin_set)
         db.session.delete(bin_set)
         db.session.commit()
 
 
+class ZipStream(io.RawIOBase):
+    """
+    Unseekable file object that keeps what is written until it is taken
+    with `pop`, to stream a zip file as it is written.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_bin_set_zip(bin_set, fasta_path):
+    """
+    :return: Generator of the chunks of a zip file with a fasta file per
+        non-empty bin, named after the bin and suffixed with a number when
+        another bin has that name. Contigs are read through the fasta index
+        and written one at a time, so only about a contig is held in memory.
+    """
+    index = fasta.read_index(fasta_path)
+    stream = ZipStream()
+    filenames = set()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as z:
+        for bin_ in bin_set.bins.filter(Bin.contig_count > 0).order_by(Bin.id):
+            contig_names = [c.name for c in bin_.contigs.options(db.load_only('name'))]
+            filename, suffix = '{}.fa'.format(bin_.name), 1
+            while filename in filenames:
+                suffix += 1
+                filename = '{}_{}.fa'.format(bin_.name, suffix)
+            filenames.add(filename)
+            with z.open(filename, 'w', force_zip64=True) as f:
+                for name, sequence in fasta.read_sequences(fasta_path, contig_names, index):
+                    f.write(b'>' + name.encode() + b'\n' + sequence + b'\n')
+                    yield stream.pop()
+            yield stream.pop()
+    yield stream.pop()
+
+
 class BinSetExportApi(Resource):
     def get(self, assembly_id, id):
         bin_set = bin_set_or_404(assembly_id, id)
         assembly = Assembly.query.get(assembly_id)
-
-        # Map contig -> bin name
-        mapping = {}
-        for contig in assembly.contigs.all():
-            bin_ = [b for b in contig.bins if b.bin_set_id == bin_set.id][0]
-            mapping[contig.name] = bin_.name
-        
-        # Build fasta strings. Map bin -> fasta string
-        fastas = {b: '' for b in set(mapping.values())}
-        fasta_path = os.path.join(app.config['BASEDIR'], 'data/assemblies', 
-                                  '{}.fa'.format(1 if assembly.demo else assembly.id))
-        for name, sequence in utils.parse_fasta(fasta_path):
-            name = name.split(' ')[0]
-            fastas[mapping[name]] += '>{}\n{}\n'.format(name, sequence)
-        
-        # Create zip file in memory
-        buffer = io.BytesIO()
-        with zipfile.ZipFile(buffer, 'a', zipfile.ZIP_DEFLATED) as z:
-            for bin_, fasta_string in fastas.items():
-                z.writestr('{}.fa'.format(bin_), fasta_string)
-
-        # Return zip file for download
-        buffer.seek(0)
-        response = make_response(buffer.read())
-        buffer.close()
+        zip_file = iter_bin_set_zip(bin_set, assembly.fasta_path)
+        response = Response(stream_with_context(zip_file), mimetype='application/zip')
         response.headers['Content-Disposition'] = 'attachment; filename='
         response.headers['Content-Disposition'] += '{}.zip'.format(bin_set.name)
         return response
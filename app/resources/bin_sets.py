@@ -23,7 +23,7 @@ def save_bin_set_job(name, assembly_id, filename=None):
     db.session.flush()
 
     # Query the contigs from the db to dict contig-name -> contig object
-    query = assembly.contigs.options(load_only('name'))
+    query = assembly.contigs.options(load_only('name', 'length', 'gc'))
     contigs = {c.name: c for c in query.all()}
 
     notfound = []
@@ -39,14 +39,18 @@ def save_bin_set_job(name, assembly_id, filename=None):
         for bin_name, bin_contigs in bins.items():
             notfound.extend([c for c in bin_contigs if c not in contigs])
             bin_contigs = [contigs.pop(c) for c in bin_contigs]
-            Bin(name=bin_name, color=randcol.generate(luminosity='dark')[0],
-                bin_set_id=bin_set.id, contigs=bin_contigs)
+            bin = Bin(name=bin_name, color=randcol.generate(luminosity='dark')[0],
+                      bin_set_id=bin_set.id)
+            db.session.add(bin)
+            db.session.flush()
+            bin.add_contigs(bin_contigs)
         os.remove(filename)
     
     # Create a bin for the unbinned contigs.
-    bin = Bin(name='unbinned', color='#939393', bin_set_id=bin_set.id,
-              contigs=list(contigs.values()), unbinned=True)
+    bin = Bin(name='unbinned', color='#939393', bin_set_id=bin_set.id, unbinned=True)
     db.session.add(bin)
+    db.session.flush()
+    bin.add_contigs(list(contigs.values()))
 
     db.session.flush()
     for bin in bin_set.bins:
@@ -2,7 +2,7 @@ from flask import abort
 from flask_restful import Resource, reqparse
 
 from .utils import bin_set_or_404
-from app import db, randomcolor
+from app import db, randomcolor, tiles
 from app.models import Bin
 
 
@@ -38,13 +38,14 @@ class BinsApi(Resource):
         unbinned = bin_set.bins.filter_by(unbinned=True).first_or_404()
         for bin in bins:
             contigs = bin.contigs.all()
-            bin.contigs = []
-            unbinned.contigs.extend(contigs)
+            bin.remove_contigs(contigs)
+            unbinned.add_contigs(contigs)
         db.session.flush()
         for bin in bins:
             db.session.delete(bin)
         unbinned.recalculate_values()
         db.session.commit()
+        tiles.invalidate(bin_set)
 
     def post(self, assembly_id, id):
         args = self.reqparse.parse_args()
@@ -1,8 +1,17 @@
+import json
+from collections import defaultdict
+
+import numpy as np
+from flask import Response, abort, request, stream_with_context
 from flask_restful import Resource, reqparse, inputs
+from flask_sqlalchemy import Pagination
 
 from .utils import user_assembly_or_404
 from app import db, app, utils
-from app.models import Contig, Bin
+from app.models import Contig, Bin, BinSet, bincontig
+
+
+COLUMNS_MIMETYPE = 'application/octet-stream'
 
 
 def filter_contigs(attr, value):
@@ -22,13 +31,76 @@ def filter_contigs(attr, value):
     else:
         filter = attr == value
     return filter
+
+
+def contig_bins(contig_ids):
+    """
+    :return: Dict contig id -> list of the (id, bin set id, color) of the
+        bins the contig is in.
+    """
+    bins = defaultdict(list)
+    q = db.session.query(bincontig.c.contig_id, Bin.id, Bin.bin_set_id, Bin.color). \
+        join(Bin, Bin.id == bincontig.c.bin_id). \
+        filter(bincontig.c.contig_id.in_(contig_ids))
+    for contig_id, *bin in q:
+        bins[contig_id].append(bin)
+    return bins
+
+
+def sort_column(sort):
+    """
+    :return: The contig column to sort on and if the order is descending.
+    """
+    if not sort:
+        return Contig.id, False
+    return getattr(Contig, sort.lstrip('-')), sort.startswith('-')
+
+
+def order_contigs(contigs, column, descending):
+    # Ties are ordered on id, so that the order is the same for every page.
+    if descending:
+        return contigs.order_by(column.desc(), Contig.id.desc())
+    return contigs.order_by(column, Contig.id)
+
+
+def seek(contigs, column, descending, after, limit):
+    """
+    Keyset pagination: the first `limit` contigs after the (sort value, id)
+    `after` in the order of the sort column and id, or the first page when
+    `after` is None. Deep pages cost the same as the first one.
+    """
+    contigs = order_contigs(contigs, column, descending)
+    if after is not None:
+        value, id = after
+        if descending:
+            contigs = contigs.filter(db.or_(column < value,
+                                            db.and_(column == value, Contig.id < id)))
+        else:
+            contigs = contigs.filter(db.or_(column > value,
+                                            db.and_(column == value, Contig.id > id)))
+    return contigs.limit(limit).all()
+
+
+def iter_pages(contigs, column, descending, page_size):
+    after = None
+    while True:
+        page = seek(contigs, column, descending, after, page_size)
+        if not page:
+            break
+        yield page
+        after = getattr(page[-1], column.key), page[-1].id
     
     
 class ContigsApi(Resource):
+    # Contigs loaded at a time when streaming.
+    stream_page_size = 5000
+
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('items', type=int, default=50, dest='_items')
-        self.reqparse.add_argument('index', type=int, default=1)
+        self.reqparse.add_argument('items', type=inputs.positive, default=50, dest='_items')
+        self.reqparse.add_argument('index', type=inputs.positive, default=1)
+        self.reqparse.add_argument('after', type=int)
+        self.reqparse.add_argument('stream', type=inputs.boolean, default=False)
         self.reqparse.add_argument('sort', type=str, choices=[
             'id', 'name', 'gc', 'length', '-id', '-name', '-gc', '-length'])
         self.reqparse.add_argument('fields', type=str,
@@ -43,22 +115,20 @@ class ContigsApi(Resource):
         super(ContigsApi, self).__init__()
 
     def get(self, assembly_id):
-        args = self.reqparse.parse_args()
-        contigs = user_assembly_or_404(assembly_id).contigs
+        """
+        Contigs by page: `index` pages by offset, `after` continues after
+        the contig with that id (keyset pagination) and `stream` sends all
+        contigs as newline delimited JSON. Pages hold the id to continue
+        after in `next`.
 
-        # Column loading
-        fields = args.fields.split(',')
-        if args.coverages:
-            fields.append('coverage')
-        if args.pca:
-            fields.extend(['pc_1', 'pc_2', 'pc_3'])
-        contigs = contigs.options(db.load_only(*fields))
+        When COLUMNS_MIMETYPE is accepted over JSON, all contigs are sent
+        as typed columns instead, see `contig_columns`.
+        """
+        args = self.reqparse.parse_args()
+        assembly = user_assembly_or_404(assembly_id)
+        contigs = assembly.contigs
+        column, descending = sort_column(args.sort)
 
-        # Sort
-        if args.sort:
-            order = db.desc(args.sort[1:]) if args.sort[0] == '-' else db.asc(args.sort)
-            contigs = contigs.order_by(order)
-        
         # Filters
         if args.length:
             for value in args.length:
@@ -68,36 +138,151 @@ class ContigsApi(Resource):
             for value in args.gc:
                 filter = filter_contigs(Contig.gc, value)
                 contigs = contigs.filter(filter)
+        bin_ids = set()
         if args.bins:
-            contigs = contigs.options(db.joinedload('bins'))
-            bin_ids = args.bins.split(',')
-            contigs = contigs.join((Bin, Contig.bins)).filter(Bin.id.in_(bin_ids))
-        
+            bin_ids = {int(id) for id in args.bins.split(',')}
+            contigs = contigs.join(bincontig, bincontig.c.contig_id == Contig.id). \
+                filter(bincontig.c.bin_id.in_(bin_ids))
+
+        mimetype = request.accept_mimetypes.best_match(['application/json', COLUMNS_MIMETYPE])
+        if mimetype == COLUMNS_MIMETYPE:
+            contigs = order_contigs(contigs, column, descending)
+            return Response(self.contig_columns(contigs, args, assembly, bin_ids),
+                            mimetype=COLUMNS_MIMETYPE)
+
+        # Column loading
+        fields = args.fields.split(',')
+        if args.coverages:
+            fields.append('coverage_values')
+        if args.pca:
+            fields.extend(['pc_1', 'pc_2', 'pc_3'])
+        contigs = contigs.options(db.load_only(*fields, column.key))
+
+        if args.stream:
+            pages = iter_pages(contigs, column, descending, self.stream_page_size)
+            lines = (json.dumps(r) + '\n'
+                     for page in pages
+                     for r in self.contig_dicts(page, args, fields, assembly, bin_ids))
+            return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+        # Without filters the count is the size of the assembly, which is
+        # cached.
+        if args.length or args.gc or args.bins:
+            count = contigs.order_by(None).count()
+        else:
+            count = assembly.size
+
+        if args.after is not None:
+            after = db.session.query(column, Contig.id). \
+                filter(Contig.id == args.after, Contig.assembly_id == assembly.id). \
+                first()
+            if after is None:
+                abort(400)
+            items = seek(contigs, column, descending, tuple(after), args._items)
+            result = self.contig_dicts(items, args, fields, assembly, bin_ids)
+            return {
+                'contigs': result if args.contigs else [],
+                'next': items[-1].id if len(items) == args._items else None,
+                'count': count,
+                'items': args._items
+            }
+
         # Load in pagination
-        contig_pagination = contigs.paginate(args.index, args._items, False)
+        contigs = order_contigs(contigs, column, descending)
+        items = contigs.limit(args._items).offset((args.index - 1) * args._items).all()
+        contig_pagination = Pagination(contigs, args.index, args._items, count, items)
+        result = self.contig_dicts(contig_pagination.items, args, fields, assembly, bin_ids)
+
+        return {
+            'contigs': result if args.contigs else [], 
+            'indices': contig_pagination.pages,
+            'index': args.index, 
+            'next': items[-1].id if len(items) == args._items else None,
+            'count': count, 
+            'items': args._items
+        }
+
+    def contig_dicts(self, contigs, args, fields, assembly, bin_ids):
+        if args.colors or args.bins:
+            bins = contig_bins([contig.id for contig in contigs])
+        if args.coverages:
+            samples = assembly.coverage_samples
+            coverages = utils.float32_values(utils.packed_matrix(
+                [contig.coverage_values for contig in contigs], len(samples)))
         
         result = []
-        for i, contig in enumerate(contig_pagination.items):
+        for i, contig in enumerate(contigs):
             r = {}
             if args.fields:
                 for field in fields:
-                    if field != 'coverage':
+                    if field != 'coverage_values':
                         r[field] = getattr(contig, field)
-            if args.coverages:
-                r.update(contig.coverages)
+            if args.coverages and contig.coverage_values is not None:
+                r.update(zip(samples, coverages[i]))
             if args.pca:
                 r['pc_1'], r['pc_2'], r['pc_3'] = contig.pc_1, contig.pc_2, contig.pc_3
             if args.colors:
-                for bin in contig.bins:
-                    r['color_{}'.format(bin.bin_set_id)] = bin.color
+                for _, bin_set_id, color in bins[contig.id]:
+                    r['color_{}'.format(bin_set_id)] = color
             if args.bins:
-                r['bin'] = [b.id for b in contig.bins if str(b.id) in bin_ids][0]
+                r['bin'] = [id for id, *_ in bins[contig.id] if id in bin_ids][0]
             result.append(r)
+        return result
 
-        return {
-            'contigs': result if args.contigs else [], 
-            'indices': contig_pagination.pages,
-            'index': args.index, 
-            'count': contigs.count(), 
-            'items': args._items
-        }
+    def contig_columns(self, contigs, args, assembly, bin_ids):
+        """
+        :return: The contigs as columns packed by `utils.pack_columns`: id,
+            length and gc, pc_1 to pc_3 with `pca`, a column per sample
+            with `coverages`, with `colors` the bin id in every bin set as
+            bin_<bin set id> (-1 for none) and with `bins` the selected bin
+            as bin. The colors of the bins are in the header.
+        """
+        entities = [Contig.id, Contig.length, Contig.gc]
+        if args.pca:
+            entities.extend([Contig.pc_1, Contig.pc_2, Contig.pc_3])
+        if args.coverages:
+            entities.append(Contig.coverage_values)
+        rows = contigs.with_entities(*entities).all()
+        values = list(zip(*rows)) or [()] * len(entities)
+
+        columns = [('id', np.array(values[0], dtype=np.int32)),
+                   ('length', np.array(values[1], dtype=np.int32)),
+                   ('gc', np.array(values[2], dtype=np.float32))]
+        if args.pca:
+            for i, name in enumerate(['pc_1', 'pc_2', 'pc_3'], 3):
+                columns.append((name, np.array(values[i], dtype=np.float64).astype(np.float32)))
+        if args.coverages:
+            samples = assembly.coverage_samples
+            coverages = utils.packed_matrix(values[-1], len(samples))
+            columns.extend((sample, coverages[:, i]) for i, sample in enumerate(samples))
+
+        colors = {}
+        ids = columns[0][1]
+        if (args.colors or args.bins) and len(ids) > 0:
+            bins = Bin.query.join(BinSet).filter(BinSet.assembly_id == assembly.id)
+            memberships = db.session.query(bincontig.c.contig_id, bincontig.c.bin_id,
+                                           Bin.bin_set_id). \
+                join(Bin, Bin.id == bincontig.c.bin_id). \
+                filter(Bin.id.in_(bins.with_entities(Bin.id))). \
+                all()
+            memberships = np.array(memberships, dtype=np.int64).reshape(-1, 3)
+            # Row of every membership of the selected contigs.
+            order = np.argsort(ids, kind='stable')
+            positions = np.searchsorted(ids, memberships[:, 0], sorter=order). \
+                clip(max=len(ids) - 1)
+            selected = ids[order[positions]] == memberships[:, 0]
+            rows = order[positions[selected]]
+            _, bin_column_ids, bin_set_ids = memberships[selected].T
+            if args.colors:
+                colors = dict(bins.with_entities(Bin.id, Bin.color))
+                for bin_set_id in np.unique(bin_set_ids).tolist():
+                    in_set = bin_set_ids == bin_set_id
+                    bin_column = np.full(len(ids), -1, dtype=np.int32)
+                    bin_column[rows[in_set]] = bin_column_ids[in_set]
+                    columns.append(('bin_{}'.format(bin_set_id), bin_column))
+            if args.bins:
+                in_bins = np.isin(bin_column_ids, list(bin_ids))
+                bin_column = np.full(len(ids), -1, dtype=np.int32)
+                bin_column[rows[in_bins]] = bin_column_ids[in_bins]
+                columns.append(('bin', bin_column))
+        return utils.pack_columns(columns, colors=colors)
@@ -6,7 +6,7 @@ from flask import abort
 import numpy as np
 
 from .utils import user_assembly_or_404
-from app import db, app, utils
+from app import db, app, utils, density
 from app.models import Contig, Bin
 
 
@@ -56,4 +56,48 @@ class ContigsPlotApi(Resource):
                 abort(404)
         contigs = assembly.contigs        
         return {'length': create_length_data(contigs, bin_set),
-                'gc': create_gc_data(contigs, bin_set)}
\ No newline at end of file
+                'gc': create_gc_data(contigs, bin_set)}
+
+
+class ContigsDensityApi(Resource):
+    # Largest number of cells along an axis.
+    max_size = 1000
+
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('x', type=str, default='gc')
+        self.reqparse.add_argument('y', type=str, default='length')
+        for bound in ['xmin', 'xmax', 'ymin', 'ymax']:
+            self.reqparse.add_argument(bound, type=float)
+        self.reqparse.add_argument('size', type=int, default=100)
+        self.reqparse.add_argument('bs', type=int)
+        super(ContigsDensityApi, self).__init__()
+
+    def get(self, assembly_id):
+        """
+        Contig counts and summed length per cell of a `size` x `size` grid,
+        see `density.density`. Axes are the contig columns of density.AXES
+        or the log10(coverage + 1) of a sample as 'coverage:<sample>'. The grid
+        covers the data unless all of xmin, xmax, ymin and ymax are given.
+        With `bs` the cells are also broken down by the bins of that bin set.
+        """
+        args = self.reqparse.parse_args()
+        assembly = user_assembly_or_404(assembly_id)
+        bin_set = None
+        if args.bs:
+            bin_set = assembly.bin_sets.filter_by(id=args.bs).first()
+            if bin_set is None:
+                abort(404)
+        if not 0 < args.size <= self.max_size:
+            abort(400)
+        extent = args.xmin, args.xmax, args.ymin, args.ymax
+        if None in extent:
+            extent = None
+        elif not (args.xmin < args.xmax and args.ymin < args.ymax):
+            abort(400)
+        columns = density.contig_columns(assembly)
+        try:
+            return density.density(columns, args.x, args.y, extent,
+                                   (args.size, args.size), bin_set)
+        except KeyError:
+            abort(400)
@@ -0,0 +1,81 @@
+from flask import abort, session
+from flask_restful import Resource, reqparse
+
+from .utils import user_assembly_or_404
+from app import q, density, tiles
+from app.models import Assembly, BinSet
+
+
+def build_tiles_job(assembly_id, x_axis, y_axis, bin_set_id=None):
+    """
+    Build the tile pyramid of the assembly on the axes if there is none,
+    and the coloured pyramid of the bin set if given.
+    """
+    assembly = Assembly.query.get(assembly_id)
+    columns = density.contig_columns(assembly)
+    pyramid = tiles.load_pyramid(assembly.id, x_axis, y_axis)
+    if pyramid is None:
+        tiles.build_pyramid(assembly.id, columns, x_axis, y_axis)
+        pyramid = tiles.load_pyramid(assembly.id, x_axis, y_axis)
+    if bin_set_id is not None:
+        bin_set = BinSet.query.get(bin_set_id)
+        if tiles.load_pyramid(assembly.id, x_axis, y_axis, bin_set) is None:
+            tiles.build_colored(assembly.id, columns, pyramid, bin_set)
+    return {'assembly': assembly.id}
+
+
+def enqueue_tiles_job(assembly, x_axis, y_axis, bin_set_id=None):
+    """
+    Enqueue the job building the pyramid, unless it is already queued or
+    running.
+    """
+    job_id = 'tiles-{}-{}'.format(assembly.id, tiles.pyramid_name(x_axis, y_axis))
+    if bin_set_id is not None:
+        job_id += '-bs{}'.format(bin_set_id)
+    job = q.fetch_job(job_id)
+    if job is None or job.is_finished or job.is_failed:
+        job_meta = {'type': 'T', 'name': assembly.name, 'assembly': assembly.id}
+        job = q.enqueue(build_tiles_job, args=[assembly.id, x_axis, y_axis, bin_set_id],
+                        meta=job_meta, job_id=job_id, timeout=60*60)
+    return job, job.meta
+
+
+class ContigsTileApi(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('x', type=str, default='gc')
+        self.reqparse.add_argument('y', type=str, default='length')
+        self.reqparse.add_argument('bs', type=int)
+        super(ContigsTileApi, self).__init__()
+
+    def get(self, assembly_id, zoom, tx, ty):
+        """
+        A tile of the pyramid of the contigs on the `x` and `y` axes, see
+        `tiles.read_tile`, broken down by the bins of bin set `bs` if given.
+        Pyramids that are not built yet are built by a job, its location is
+        returned instead.
+        """
+        args = self.reqparse.parse_args()
+        assembly = user_assembly_or_404(assembly_id)
+        bin_set = None
+        if args.bs:
+            bin_set = assembly.bin_sets.filter_by(id=args.bs).first()
+            if bin_set is None:
+                abort(404)
+        axes = density.axis_names(assembly)
+        if args.x not in axes or args.y not in axes:
+            abort(400)
+        if zoom > tiles.MAX_ZOOM or tx >= 1 << zoom or ty >= 1 << zoom:
+            abort(404)
+        if assembly.busy:
+            abort(409)
+        pyramid = tiles.load_pyramid(assembly.id, args.x, args.y)
+        colored = None
+        if pyramid is not None and bin_set is not None:
+            colored = tiles.load_pyramid(assembly.id, args.x, args.y, bin_set)
+        if pyramid is None or (bin_set is not None and colored is None):
+            job, job_meta = enqueue_tiles_job(assembly, args.x, args.y, args.bs)
+            if job.id not in session['jobs']:
+                session['jobs'].append(job.id)
+            return job_meta, 202, {'Location': '/jobs/{}'.format(job.id)}
+        return tiles.read_tile(pyramid, zoom, tx, ty, colored)
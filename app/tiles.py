@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+from urllib.parse import quote
+
+import numpy as np
+
+from app import app, density
+
+
+# Cells along each side of a tile, a power of 2.
+TILE_BITS = 6
+TILE_SIZE = 1 << TILE_BITS
+# At zoom level z the extent is split in 2**z tiles along each side.
+MAX_ZOOM = 8
+# Tiles with at most this many contigs are served as points.
+POINTS_LIMIT = 2000
+# Stored in the pyramids, older versions are rebuilt.
+PYRAMID_VERSION = 2
+
+
+def tiles_path(assembly_id, *names):
+    return os.path.join(app.config['BASEDIR'], 'data/tiles', str(assembly_id), *names)
+
+
+def pyramid_name(x_axis, y_axis):
+    return '{}+{}'.format(quote(x_axis, safe=''), quote(y_axis, safe=''))
+
+
+def pyramid_path(assembly_id, x_axis, y_axis, bin_set_id=None):
+    path = tiles_path(assembly_id, pyramid_name(x_axis, y_axis))
+    if bin_set_id is not None:
+        path = os.path.join(path, 'bs{}'.format(bin_set_id))
+    return path
+
+
+def default_axes(assembly):
+    """
+    :return: The axis pairs to build pyramids of after ingestion.
+    """
+    return [('gc', 'length')] + [('gc', axis) for axis in density.axis_names(assembly)
+                                 if axis.startswith(density.COVERAGE_AXIS)]
+
+
+def _spread(values):
+    # Move the bits of the 16-bit values to the even positions.
+    v = np.asarray(values, dtype=np.int64) & 0xffff
+    v = (v | v << 8) & 0x00ff00ff
+    v = (v | v << 4) & 0x0f0f0f0f
+    v = (v | v << 2) & 0x33333333
+    return (v | v << 1) & 0x55555555
+
+
+def _compact(keys):
+    v = np.asarray(keys, dtype=np.int64) & 0x55555555
+    v = (v | v >> 1) & 0x33333333
+    v = (v | v >> 2) & 0x0f0f0f0f
+    v = (v | v >> 4) & 0x00ff00ff
+    return (v | v >> 8) & 0xffff
+
+
+def morton(ix, iy):
+    """
+    :return: The Z-order key of cells, interleaving the bits of the x and y
+        index. The cells of a quadtree node have consecutive keys, so that
+        every tile at every zoom level is a range of sorted keys.
+    """
+    return _spread(ix) | _spread(iy) << 1
+
+
+def _write_pyramid(path, arrays, meta):
+    # Written next to the pyramid first, so that it is replaced at once.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.tmp', dir=os.path.dirname(path))
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), values)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+
+def _levels(arrays, cells, lengths, levels, groups=None, group_count=1):
+    for zoom in range(levels):
+        keys = cells >> 2 * (MAX_ZOOM - zoom)
+        if groups is not None:
+            keys = keys * group_count + groups
+        keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        arrays['level_{}_key'.format(zoom)] = keys
+        arrays['level_{}_count'.format(zoom)] = counts
+        arrays['level_{}_bp'.format(zoom)] = np.bincount(
+            inverse.ravel(), weights=lengths, minlength=len(keys)).astype(np.int64)
+
+
+def build_pyramid(assembly_id, columns, x_axis, y_axis):
+    """
+    Build the tile pyramid of the contigs on two axes, over the extent of
+    the data. The contigs are stored sorted by the Z-order key of their
+    cell at the deepest zoom level, with the counts and summed length per
+    cell of the zoom levels that have tiles of more than POINTS_LIMIT
+    contigs. Replaces the pyramid and its coloured pyramids.
+    """
+    x, y = columns.axis(x_axis), columns.axis(y_axis)
+    extent = density.data_extent(x, y)
+    resolution = TILE_SIZE << MAX_ZOOM
+    ix, iy, inside = density.cell_indices(x, y, extent, (resolution, resolution))
+    keys = morton(ix, iy)
+    order = np.argsort(keys, kind='stable')
+    positions = np.flatnonzero(inside)[order]
+    keys = keys[order]
+    arrays = {'key': keys, 'id': columns.ids[positions], 'x': x[positions],
+              'y': y[positions], 'length': columns.length[positions]}
+    levels = 0
+    while levels <= MAX_ZOOM:
+        tiles = keys >> 2 * (MAX_ZOOM - levels + TILE_BITS)
+        if len(tiles) == 0 or np.unique(tiles, return_counts=True)[1].max() <= POINTS_LIMIT:
+            break
+        levels += 1
+    _levels(arrays, keys, arrays['length'], levels)
+    meta = {'x': x_axis, 'y': y_axis, 'extent': list(extent), 'levels': levels,
+            'version': PYRAMID_VERSION}
+    _write_pyramid(pyramid_path(assembly_id, x_axis, y_axis), arrays, meta)
+
+
+def build_colored(assembly_id, columns, pyramid, bin_set):
+    """
+    Build the pyramid of the cells broken down by the bins of the bin set,
+    on top of the pyramid of the axes.
+    """
+    built = time.time()
+    bins, groups = density.bin_membership(columns, bin_set)
+    groups = groups[columns.positions(pyramid.array('id'))]
+    binned = groups != -1
+    arrays = {'group': groups}
+    _levels(arrays, pyramid.array('key')[binned], pyramid.array('length')[binned],
+            pyramid.meta['levels'], groups[binned], max(len(bins), 1))
+    meta = {'bins': [[id, color] for id, _, color in bins], 'built': built}
+    path = pyramid_path(assembly_id, pyramid.meta['x'], pyramid.meta['y'], bin_set.id)
+    _write_pyramid(path, arrays, meta)
+
+
+def invalidate(bin_set):
+    """
+    Remove the coloured pyramids of the bin set, after its bins or their
+    colours changed. Builds that started before are discarded on load.
+    """
+    path = tiles_path(bin_set.assembly_id)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'bs{}.changed'.format(bin_set.id)), 'w'):
+        pass
+    for name in os.listdir(path):
+        shutil.rmtree(os.path.join(path, name, 'bs{}'.format(bin_set.id)), ignore_errors=True)
+
+
+def remove(assembly_id):
+    shutil.rmtree(tiles_path(assembly_id), ignore_errors=True)
+
+
+class Pyramid:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+    def array(self, name):
+        path = os.path.join(self.path, name + '.npy')
+        # Empty arrays can not be mapped.
+        if os.path.getsize(path) <= 128:
+            return np.load(path)
+        return np.load(path, mmap_mode='r')
+
+
+def load_pyramid(assembly_id, x_axis, y_axis, bin_set=None):
+    """
+    :return: The Pyramid of the axes, or the coloured one of the bin set,
+        None when it is not built or was built by an older version.
+    """
+    path = pyramid_path(assembly_id, x_axis, y_axis, None if bin_set is None else bin_set.id)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    pyramid = Pyramid(path)
+    # Coloured pyramids are removed when their pyramid is rebuilt.
+    if bin_set is None and pyramid.meta.get('version') != PYRAMID_VERSION:
+        return None
+    if bin_set is not None:
+        marker = tiles_path(assembly_id, 'bs{}.changed'.format(bin_set.id))
+        if os.path.exists(marker) and os.path.getmtime(marker) >= pyramid.meta['built']:
+            return None
+    return pyramid
+
+
+def tile_extent(extent, zoom, tx, ty):
+    xmin, xmax, ymin, ymax = extent
+    width, height = (xmax - xmin) / (1 << zoom), (ymax - ymin) / (1 << zoom)
+    return [xmin + tx * width, xmin + (tx + 1) * width,
+            ymin + ty * height, ymin + (ty + 1) * height]
+
+
+def _tile_cells(pyramid, zoom, tile, group_count=1):
+    keys = pyramid.array('level_{}_key'.format(zoom))
+    first = int(tile) << 2 * TILE_BITS
+    start, stop = np.searchsorted(keys, [first * group_count,
+                                         (first + (1 << 2 * TILE_BITS)) * group_count])
+    cells, groups = np.divmod(np.asarray(keys[start:stop]), group_count)
+    cells &= (1 << 2 * TILE_BITS) - 1
+    rows = np.column_stack([_compact(cells), _compact(cells >> 1),
+                            pyramid.array('level_{}_count'.format(zoom))[start:stop],
+                            pyramid.array('level_{}_bp'.format(zoom))[start:stop]])
+    return groups, rows.tolist()
+
+
+def read_tile(pyramid, zoom, tx, ty, colored=None):
+    """
+    The tile at (tx, ty) of the zoom level, counted from the lower x and y
+    of the extent. Tiles with more than POINTS_LIMIT contigs, at the zoom
+    levels that are aggregated, hold the [x, y, count, bp] of their non-empty
+    cells in a TILE_SIZE x TILE_SIZE grid like `density.density`. Other
+    tiles hold the contigs as points.
+    :param colored: Coloured pyramid, to break the cells down by bin or
+        give the bin of every point.
+    """
+    tile = morton(tx, ty)
+    shift = 2 * (MAX_ZOOM - zoom + TILE_BITS)
+    start, stop = np.searchsorted(pyramid.array('key'), [tile << shift, (tile + 1) << shift])
+    data = {'zoom': zoom, 'tile': [tx, ty], 'count': int(stop - start),
+            'extent': tile_extent(pyramid.meta['extent'], zoom, tx, ty)}
+    bins = [] if colored is None else colored.meta['bins']
+    if zoom < pyramid.meta['levels'] and stop - start > POINTS_LIMIT:
+        data['size'] = TILE_SIZE
+        data['cells'] = _tile_cells(pyramid, zoom, tile)[1]
+        if colored is not None:
+            per_bin = {}
+            for group, row in zip(*_tile_cells(colored, zoom, tile, max(len(bins), 1))):
+                per_bin.setdefault(group, []).append(row)
+            data['bins'] = [{'id': id, 'color': color, 'cells': per_bin.get(i, [])}
+                            for i, (id, color) in enumerate(bins)]
+        return data
+    data['points'] = {name: pyramid.array(name)[start:stop].tolist()
+                      for name in ['id', 'x', 'y', 'length']}
+    if colored is not None:
+        # Points in no bin have group -1, the last id.
+        ids = [id for id, _ in bins] + [None]
+        data['points']['bin'] = [ids[group] for group in colored.array('group')[start:stop]]
+        data['bins'] = [{'id': id, 'color': color} for id, color in bins]
+    return data
@@ -1,11 +1,23 @@
+import io
 import csv
-from collections import defaultdict
+import gzip
+import json
+from itertools import product, chain
+from collections import defaultdict, namedtuple
 
 import numpy as np
 
+from app import fasta, bgzf
 from app.models import Contig
 
 
+BASES = 'atcg'
+# Map every byte to its 2-bit base code, ambiguous bases (N etc.) to 4.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(BASES):
+    BASE_CODES[ord(base)] = BASE_CODES[ord(base.upper())] = code
+
+
 def sort_bins(bins, reverse=False):
     return sorted(bins, key=gc_content_bin, reverse=reverse)
 
@@ -19,17 +31,56 @@ def gc_content_bin(bin):
     return float('{0:.3f}'.format(gc / atcg)) if atcg else 0
 
 
-def n50(bin):
-    contigs = bin.contigs.all()
-    if len(contigs) == 0:
+def gc_content_sum(gc_sum, total_length):
+    """
+    :param gc_sum: Sum of the gc content times the length of contigs.
+    """
+    return float('{0:.3f}'.format(gc_sum / total_length)) if total_length else 0
+
+
+def n50(lengths, counts=None):
+    """
+    :param lengths: Sorted array of contig lengths.
+    :param counts: Number of contigs of every length, one each by default.
+    """
+    if len(lengths) == 0:
         return 0
-    lengths = sorted([int(c.length) for c in bin.contigs])
-    half = sum(lengths) / 2.
-    total = 0
-    for length in lengths:
-        total += length
-        if total >= half:
-            return length
+    cumulative = np.cumsum(lengths if counts is None else lengths * counts)
+    return int(lengths[np.searchsorted(cumulative, cumulative[-1] / 2.)])
+
+
+def add_lengths(length_counts, lengths, sign=1):
+    """
+    Update a length histogram with the lengths of added or removed contigs,
+    touching only the rows of those lengths.
+    :param length_counts: int64 array of (length, count) rows, sorted by
+        length, of the distinct contig lengths.
+    :param sign: 1 to add the lengths, -1 to remove them.
+    :return: The updated histogram, without lengths that have no contigs.
+    """
+    values, counts = np.unique(np.asarray(lengths, dtype=np.int64), return_counts=True)
+    counts *= sign
+    positions = np.searchsorted(length_counts[:, 0], values)
+    found = positions < len(length_counts)
+    found[found] = length_counts[positions[found], 0] == values[found]
+    length_counts = length_counts.copy()
+    length_counts[positions[found], 1] += counts[found]
+    length_counts = np.insert(length_counts, positions[~found],
+                              np.column_stack([values[~found], counts[~found]]), axis=0)
+    return length_counts[length_counts[:, 1] != 0]
+
+
+def completeness_contamination(gene_counts):
+    """
+    :param gene_counts: Count per essential gene, or a matrix with the
+        counts of a contig set per row.
+    :return: The fraction of essential genes found and found more than once.
+    """
+    gene_counts = np.asarray(gene_counts)
+    total_reference = gene_counts.shape[-1]
+    completeness = np.round((gene_counts > 0).sum(axis=-1) / total_reference, 4)
+    contamination = np.round((gene_counts > 1).sum(axis=-1) / total_reference, 4)
+    return completeness.tolist(), contamination.tolist()
 
 
 def parse_fasta(fasta_file):
@@ -48,19 +99,91 @@ def parse_fasta(fasta_file):
 
 
 def gc_content(sequence):
-    gc = sequence.lower().count('g') + sequence.lower().count('c')
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii', 'replace')
+    sequence = sequence.lower()
+    gc = sequence.count(b'g') + sequence.count(b'c')
     return float('{0:.3f}'.format(gc / len(sequence)))
 
 
-def parse_dsv(dsv_file, delimiter=None):
-    try:
-        dsv_file_contents = dsv_file.read()
-    except AttributeError:
-        with open(dsv_file, 'r') as f:
-            dsv_file_contents = f.read()
+def kmers(k=4):
+    return [''.join(kmer) for kmer in product(BASES, repeat=k)]
+
+
+def kmer_frequencies(sequence, k=4):
+    """
+    :param sequence: Nucleotide sequence as str or bytes, any case.
+    :param k: Length of the k-mers.
+    :return: Array of 4**k frequencies, ordered as `kmers(k)`.
+
+    Windows containing an ambiguous base are not counted, but they still
+    count towards the total the frequencies are relative to.
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii', 'replace')
+    codes = BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    windows = len(codes) - k + 1
+    if windows <= 0:
+        return np.zeros(4 ** k)
+    # A window is valid when it holds no ambiguous base.
+    ambiguous = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = ambiguous[k:] == ambiguous[:-k]
+    codes = codes.astype(np.int64) & 3
+    index = np.zeros(windows, dtype=np.int64)
+    for i in range(k):
+        index <<= 2
+        index |= codes[i:i + windows]
+    counts = np.bincount(index[valid], minlength=4 ** k)
+    return counts / windows
+
+
+ContigFeatures = namedtuple('ContigFeatures', ['name', 'length', 'gc', 'fourmers', 'end'])
+
+
+def contig_features(fasta_path, calculate_fourmers, start=0, end=None):
+    """
+    :return: Generator of ContigFeatures for the contigs in the fasta file,
+        or the part of it between the `start` and `end` byte offsets. `end`
+        of a ContigFeatures is the byte offset where its record ends.
+    """
+    for record in fasta.read_fasta(fasta_path, start=start, end=end):
+        fourmers = None
+        if calculate_fourmers:
+            fourmers = pack_floats(kmer_frequencies(record.sequence, 4))
+        yield ContigFeatures(record.name.split(' ')[0], record.length,
+                             gc_content(record.sequence), fourmers, record.end)
+
+
+def open_text(path):
+    """
+    Open a plain or gzip compressed text file for reading.
+    """
+    if bgzf.is_gzip(path):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+
+def parse_dsv(dsv_file, delimiter=None, sniff_size=64 * 1024):
+    """
+    Stream the rows of a delimiter separated file, given as path or text
+    file object. The delimiter is sniffed from the first `sniff_size`
+    characters only.
+    """
+    if hasattr(dsv_file, 'read'):
+        yield from _parse_dsv(dsv_file, delimiter, sniff_size)
+    else:
+        with open_text(dsv_file) as f:
+            yield from _parse_dsv(f, delimiter, sniff_size)
+
+
+def _parse_dsv(f, delimiter, sniff_size):
+    prefix = f.read(sniff_size)
+    if not prefix.endswith('\n'):
+        prefix += f.readline()
     if delimiter is None:
-        delimiter = csv.Sniffer().sniff(dsv_file_contents).delimiter
-    for line in dsv_file_contents.splitlines():
+        delimiter = csv.Sniffer().sniff(prefix).delimiter
+    for line in chain(io.StringIO(prefix), f):
+        line = line.rstrip('\r\n')
         if line == '': continue
         yield line.rstrip().split(delimiter)
 
@@ -107,12 +230,106 @@ def pca(data, num_components):
     # carry out the transformation on the data using eigenvectors
     # and return the re-scaled data, eigenvalues, and eigenvectors
     return np.dot(evecs.T, data.T).T, evals, evecs
-    
+
+
+class StreamingPCA:
+    """
+    PCA on data that is seen in chunks. The mean and covariance are
+    accumulated chunk by chunk with `update`, after which chunks can be
+    projected with `transform`. Memory use only depends on the number of
+    features and the chunk size.
+    """
+    def __init__(self, num_features, num_components=3):
+        self.num_components = num_components
+        self.count = 0
+        self.sum = np.zeros(num_features)
+        self.sum_products = np.zeros((num_features, num_features))
+        self.mean = None
+        self.evecs = None
+
+    def update(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        self.count += len(data)
+        self.sum += data.sum(axis=0)
+        self.sum_products += np.dot(data.T, data)
+        self.evecs = None
+
+    def fit(self):
+        self.mean = self.sum / self.count
+        R = (self.sum_products - self.count * np.outer(self.mean, self.mean))
+        R /= max(self.count - 1, 1)
+        evals, evecs = np.linalg.eigh(R)
+        idx = np.argsort(evals)[::-1]
+        self.evecs = evecs[:, idx][:, :self.num_components]
+
+    def transform(self, data):
+        if self.evecs is None:
+            self.fit()
+        return np.dot(np.asarray(data, dtype=np.float64) - self.mean, self.evecs)
+
+
+def pack_columns(columns, **header):
+    """
+    Lay out typed columns in one buffer: the length of the header as
+    little-endian uint32, the JSON header padded to a multiple of 8 bytes
+    and the data of every column, each at an offset that is a multiple of
+    8, so that they can be read as typed arrays without copying.
+
+    :param columns: List of (name, 1d numpy array) of equal length.
+    :param header: Extra values for the header.
+    :return: The buffer as bytes. The header holds `count`, the number of
+        rows, and `columns` with the name, dtype and byte offset of each
+        column from the start of the data.
+    """
+    descriptions, offset = [], 0
+    for name, values in columns:
+        descriptions.append({'name': name, 'dtype': values.dtype.name, 'offset': offset})
+        offset += -(-values.nbytes // 8) * 8
+    count = len(columns[0][1]) if columns else 0
+    header = json.dumps(dict(header, count=count, columns=descriptions)).encode()
+    header += b' ' * (-(len(header) + 4) % 8)
+    buffer = io.BytesIO()
+    buffer.write(np.uint32(len(header)).tobytes())
+    buffer.write(header)
+    for _, values in columns:
+        data = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder('<')).tobytes()
+        buffer.write(data + b'\0' * (-len(data) % 8))
+    return buffer.getvalue()
+
+
+def pack_floats(values):
+    return np.asarray(values, dtype=np.float32).tobytes()
+
+
+def packed_matrix(packed, width):
+    """
+    :param packed: Iterable of float vectors packed by `pack_floats`, or None.
+    :param width: Length of the vectors.
+    :return: Read-only float32 matrix with a row per vector, sharing the
+        memory of the joined buffer. Rows of None are NaN.
+    """
+    missing = np.full(width, np.nan, dtype=np.float32).tobytes()
+    packed = [missing if p is None else p for p in packed]
+    matrix = np.frombuffer(b''.join(packed), dtype=np.float32)
+    return matrix.reshape(len(packed), width)
+
+
+def float32_values(matrix):
+    """
+    :return: The float32 values as (nested) lists of floats, rounded to the
+        shortest decimal that reads back as the same float32, so that a
+        stored 5.9 is 5.9 and not 5.900000095367432. NaN is None, as NaN is
+        not valid JSON.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    values = matrix.astype(str).astype(np.float64).astype(object)
+    values[np.isnan(matrix)] = None
+    return values.tolist()
+
 
 def pca_fourmerfreqs(contigs, num_components=3):
-    data = np.array([[float(x) for x in contig.fourmerfreqs.split(',')] 
-                      for contig in contigs])
-    p_components, *_ = pca(data, num_components)
+    data = packed_matrix((contig.fourmers for contig in contigs), 4 ** 4)
+    p_components, *_ = pca(data.astype(np.float64), num_components)
     return p_components
 
 
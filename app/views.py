@@ -41,7 +41,8 @@ def create_demo_job(userid):
     # Add bin sets
     for bin_set in demo_assembly.bin_sets.all():
         bins = []
-        for bin in bin_set.bins.all():
+        bins_query = bin_set.bins.options(db.undefer('gene_counts'), db.undefer('length_counts'))
+        for bin in bins_query.all():
             bin_contigs = [contig_mapper[c.id] for c in bin.contigs.all()]
             clear_session_object(bin)
             bin.contigs = bin_contigs
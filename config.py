@@ -9,3 +9,15 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_ECHO = False
 DEBUG = False
 HOST = '0.0.0.0'
+
+# Number of processes computing contig features during assembly ingestion.
+INGEST_PROCESSES = 1
+# Number of contigs inserted per batch during assembly ingestion.
+INGEST_BATCH_SIZE = 20000
+# Number of shards the essential gene search (prodigal and hmmsearch) runs in parallel.
+GENE_SEARCH_PROCESSES = 1
+# Executables of the essential gene search.
+PRODIGAL = 'prodigal'
+HMMSEARCH = 'hmmsearch'
+# Store uploaded assemblies bgzip compressed.
+STORE_COMPRESSED = False
@@ -6,9 +6,10 @@ from collections import defaultdict
 
 from flask_script import Manager
 from app import app, db
-from app.models import BinSet, EssentialGene
+from app.models import BinSet, EssentialGene, Assembly
+from app.resources.assemblies import enqueue_assembly_job
 
-from scripts import export_data
+from scripts import export_data, benchmark, migrate
 
 
 manager = Manager(app)
@@ -61,5 +62,54 @@ def table():
     export_data.list_tables()
 
 
+@manager.command
+def migrate_fourmerfreqs():
+    migrate.migrate_fourmerfreqs()
+
+
+@manager.command
+def migrate_coverages():
+    migrate.migrate_coverages()
+
+
+@manager.command
+def migrate_checkpoints():
+    migrate.migrate_checkpoints()
+
+
+@manager.command
+def migrate_content_hash():
+    migrate.migrate_content_hash()
+
+
+@manager.command
+def migrate_bin_aggregates():
+    migrate.migrate_bin_aggregates()
+
+
+@manager.command
+def migrate_bin_statistics():
+    migrate.migrate_bin_statistics()
+
+
+@manager.option('-i', '--id', dest='id_')
+def resume(id_):
+    assembly = Assembly.query.get(id_)
+    if assembly is None or not assembly.busy:
+        print('Assembly {} is not being saved'.format(id_))
+        return
+    coverage_path = os.path.join(app.config['BASEDIR'], 'data/assemblies',
+                                 '{}.coverage'.format(assembly.id))
+    if not os.path.exists(coverage_path):
+        coverage_path = None
+    job, _ = enqueue_assembly_job(assembly, assembly.fasta_path, coverage_path)
+    print('Resuming assembly', assembly.id, 'in job', job.id)
+
+
+@manager.option('-f', '--file', dest='file')
+def benchmark_fasta(file):
+    benchmark.benchmark_fasta(file)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,25 @@
+import os
+from time import perf_counter
+
+from app import utils, fasta
+
+
+def _time(parse, path):
+    start = perf_counter()
+    count = 0
+    for _ in parse(path):
+        count += 1
+    return perf_counter() - start, count
+
+
+def benchmark_fasta(path):
+    size = os.path.getsize(path) / 1000000
+    parsers = [
+        ('parse_fasta', utils.parse_fasta),
+        ('read_fasta', fasta.read_fasta),
+        ('read_fasta (headers)', lambda p: fasta.read_fasta(p, headers_only=True))
+    ]
+    print('Parser', 'Contigs', 'Seconds', 'MB/s', sep='\t')
+    for name, parse in parsers:
+        seconds, count = _time(parse, path)
+        print(name, count, '{:.2f}'.format(seconds), '{:.1f}'.format(size / seconds), sep='\t')
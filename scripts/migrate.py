@@ -0,0 +1,179 @@
+import json
+
+import numpy as np
+from sqlalchemy import inspect, bindparam, func
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from app import db, utils
+from app.models import Assembly, Bin, Contig, bincontig
+
+
+contig = db.table('contig', db.column('id'), db.column('assembly_id'),
+                  db.column('fourmerfreqs'), db.column('fourmers', db.LargeBinary),
+                  db.column('coverage'), db.column('coverage_values', db.LargeBinary))
+
+
+def table_columns(table):
+    return [column['name'] for column in inspect(db.engine).get_columns(table)]
+
+
+def contig_columns():
+    return table_columns('contig')
+
+
+def add_column(table, name, type_):
+    type_ = type_.compile(dialect=db.engine.dialect)
+    db.session.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, type_))
+    db.session.commit()
+
+
+def drop_column(table, name):
+    try:
+        db.session.execute('ALTER TABLE {} DROP COLUMN {}'.format(table, name))
+    except (OperationalError, ProgrammingError):
+        # SQLite before 3.35 can not drop columns, only free the space.
+        db.session.rollback()
+        db.session.execute('UPDATE {} SET {} = NULL'.format(table, name))
+    db.session.commit()
+
+
+def migrate_fourmerfreqs(batch_size=10000):
+    """
+    Convert the comma separated fourmer frequencies of existing contigs to
+    the packed `fourmers` column and drop the old column.
+    """
+    columns = contig_columns()
+    if 'fourmerfreqs' not in columns:
+        print('Fourmer frequencies already migrated')
+        return
+    if 'fourmers' not in columns:
+        add_column('contig', 'fourmers', db.LargeBinary())
+
+    update = contig.update(). \
+        where(contig.c.id == bindparam('_id')). \
+        values(fourmers=bindparam('fourmers'))
+    last_id, count = 0, 0
+    while True:
+        rows = db.session.query(contig.c.id, contig.c.fourmerfreqs). \
+            filter(contig.c.id > last_id, contig.c.fourmerfreqs.isnot(None)). \
+            order_by(contig.c.id). \
+            limit(batch_size). \
+            all()
+        if not rows:
+            break
+        values = [{'_id': id, 'fourmers': utils.pack_floats(
+                       np.array(fourmerfreqs.split(','), dtype=np.float32))}
+                  for id, fourmerfreqs in rows]
+        db.session.execute(update, values)
+        db.session.commit()
+        last_id = rows[-1][0]
+        count += len(rows)
+        print('Migrated', count, 'contigs')
+    drop_column('contig', 'fourmerfreqs')
+
+
+def migrate_coverages(batch_size=10000):
+    """
+    Convert the JSON coverages of existing contigs to the packed
+    `coverage_values` column and drop the old column.
+    """
+    columns = contig_columns()
+    if 'coverage' not in columns:
+        print('Coverages already migrated')
+        return
+    if 'coverage_values' not in columns:
+        add_column('contig', 'coverage_values', db.LargeBinary())
+
+    update = contig.update(). \
+        where(contig.c.id == bindparam('_id')). \
+        values(coverage_values=bindparam('coverage_values'))
+    for assembly in Assembly.query.all():
+        samples = assembly.coverage_samples
+        last_id, count = 0, 0
+        while True:
+            rows = db.session.query(contig.c.id, contig.c.coverage). \
+                filter(contig.c.assembly_id == assembly.id, contig.c.id > last_id). \
+                order_by(contig.c.id). \
+                limit(batch_size). \
+                all()
+            if not rows:
+                break
+            values = []
+            for id, coverage in rows:
+                coverage = json.loads(coverage or '{}')
+                if coverage:
+                    coverage = utils.pack_floats([coverage.get(sample, 'nan') for sample in samples])
+                values.append({'_id': id, 'coverage_values': coverage or None})
+            db.session.execute(update, values)
+            db.session.commit()
+            last_id = rows[-1][0]
+            count += len(rows)
+        print('Migrated', count, 'contigs of assembly', assembly.id)
+    drop_column('contig', 'coverage')
+
+
+def migrate_checkpoints():
+    """
+    Add the ingestion checkpoint columns of assemblies.
+    """
+    columns = table_columns('assembly')
+    for name, type_ in [('ingest_offset', db.BigInteger()),
+                        ('genes_done', db.Boolean()),
+                        ('pca_done', db.Boolean())]:
+        if name not in columns:
+            add_column('assembly', name, type_)
+            print('Added assembly column', name)
+
+
+def migrate_content_hash():
+    """
+    Add the content hash column of assemblies. Assemblies uploaded before
+    have no hash and so never share cached features.
+    """
+    if 'content_hash' not in table_columns('assembly'):
+        add_column('assembly', 'content_hash', db.String(64))
+        print('Added assembly column content_hash')
+
+
+def migrate_bin_aggregates():
+    """
+    Add the contig count and total length columns of bins and fill them in.
+    """
+    columns = table_columns('bin')
+    for name, type_ in [('contig_count', db.Integer()), ('total_bp', db.BigInteger())]:
+        if name not in columns:
+            add_column('bin', name, type_)
+            print('Added bin column', name)
+    bin_ = Bin.__table__
+    aggregates = db.session.query(bincontig.c.bin_id, func.count(), func.sum(Contig.length)). \
+        join(Contig, Contig.id == bincontig.c.contig_id). \
+        group_by(bincontig.c.bin_id)
+    values = [{'_id': bin_id, 'contig_count': count, 'total_bp': total_bp}
+              for bin_id, count, total_bp in aggregates]
+    db.session.execute(bin_.update().values(contig_count=0, total_bp=0))
+    if values:
+        db.session.execute(bin_.update().
+                           where(bin_.c.id == bindparam('_id')).
+                           values(contig_count=bindparam('contig_count'),
+                                  total_bp=bindparam('total_bp')),
+                           values)
+    db.session.commit()
+    print('Updated', len(values), 'bins')
+
+
+def migrate_bin_statistics():
+    """
+    Add the gc sum, gene count and length histogram columns of bins and
+    fill them in.
+    """
+    columns = table_columns('bin')
+    for name, type_ in [('gc_sum', db.Float()),
+                        ('gene_counts', db.LargeBinary()),
+                        ('length_counts', db.LargeBinary())]:
+        if name not in columns:
+            add_column('bin', name, type_)
+            print('Added bin column', name)
+    for bin_ in Bin.query.all():
+        bin_.recount()
+        db.session.commit()
+    print('Updated', Bin.query.count(), 'bins')
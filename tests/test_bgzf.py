@@ -0,0 +1,80 @@
+import os
+import gzip
+import random
+import tempfile
+import unittest
+
+from app import bgzf
+
+
+class BgzfTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dirname.cleanup)
+        rng = random.Random(0)
+        self.data = bytes(rng.choice(b'ACGT\n') for _ in range(3 * bgzf.BLOCK_SIZE + 1000))
+        # A marker that spans the boundary of the first two blocks.
+        start = bgzf.BLOCK_SIZE - 3
+        self.data = self.data[:start] + b'>marker' + self.data[start + 7:]
+        self.path = os.path.join(self.dirname.name, 'data.gz')
+        with bgzf.BgzfWriter(self.path) as f:
+            # Writes that do not line up with the blocks.
+            for i in range(0, len(self.data), 10000):
+                f.write(self.data[i:i + 10000])
+
+    def test_gzip_compatible(self):
+        self.assertTrue(bgzf.is_gzip(self.path))
+        with open(self.path, 'rb') as f:
+            self.assertTrue(bgzf.is_bgzf_header(f.read(18)))
+        with gzip.open(self.path) as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_index(self):
+        coffsets, uoffsets = bgzf.build_index(self.path)
+        # The empty end of file block comes last.
+        self.assertEqual(uoffsets, [0, bgzf.BLOCK_SIZE, 2 * bgzf.BLOCK_SIZE,
+                                    3 * bgzf.BLOCK_SIZE, len(self.data), len(self.data)])
+        self.assertEqual(coffsets[-2], os.path.getsize(self.path) - len(bgzf.EOF_BLOCK))
+        self.assertEqual(coffsets[-1], os.path.getsize(self.path))
+        self.assertTrue(os.path.exists(self.path + '.gzi'))
+        self.assertEqual(bgzf.read_index(self.path), (coffsets, uoffsets))
+        os.remove(self.path + '.gzi')
+        self.assertEqual(bgzf.read_index(self.path), (coffsets, uoffsets))
+
+    def test_read(self):
+        with bgzf.BgzfFile(self.path, cache_size=1) as f:
+            self.assertEqual(len(f), len(self.data))
+            self.assertEqual(f[:], self.data)
+            for boundary in [bgzf.BLOCK_SIZE, 2 * bgzf.BLOCK_SIZE, 3 * bgzf.BLOCK_SIZE]:
+                for start, end in [(boundary - 1, boundary + 1), (boundary - 5000, boundary),
+                                   (boundary, boundary + 5000), (10, boundary + 10)]:
+                    self.assertEqual(f[start:end], self.data[start:end])
+                    self.assertEqual(f.read(start, end), self.data[start:end])
+                self.assertEqual(f[boundary], self.data[boundary])
+            self.assertEqual(f[len(self.data) - 10:len(self.data) + 10], self.data[-10:])
+            self.assertEqual(f[100:50], b'')
+
+    def test_find(self):
+        with bgzf.BgzfFile(self.path, cache_size=1) as f:
+            self.assertEqual(f.find(b'>marker'), self.data.find(b'>marker'))
+            self.assertEqual(f.find(b'>marker'), bgzf.BLOCK_SIZE - 3)
+            for start in [0, 1, bgzf.BLOCK_SIZE - 3, bgzf.BLOCK_SIZE - 2, bgzf.BLOCK_SIZE]:
+                for end in [bgzf.BLOCK_SIZE + 3, bgzf.BLOCK_SIZE + 4, None]:
+                    self.assertEqual(f.find(b'>marker', start, end),
+                                     self.data.find(b'>marker', start, end), (start, end))
+            position = 0
+            for _ in range(200):
+                position = self.data.find(b'\n', position + 1)
+                self.assertEqual(f.find(b'\n', position), position)
+                self.assertEqual(f.find(b'\nA', position), self.data.find(b'\nA', position))
+            self.assertEqual(f.find(b'N'), -1)
+            self.assertEqual(f.find(b'A', len(self.data)), -1)
+
+    def test_empty(self):
+        path = os.path.join(self.dirname.name, 'empty.gz')
+        with bgzf.BgzfWriter(path):
+            pass
+        with bgzf.BgzfFile(path) as f:
+            self.assertEqual(len(f), 0)
+            self.assertEqual(f[:], b'')
+            self.assertEqual(f.find(b'>'), -1)
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+
+from app import fasta, bgzf
+
+
+RECORDS = [
+    # Name, header and sequence lines.
+    ('regular', 'regular first contig', ['ACGTACGT', 'ACGTACGT', 'ACG']),
+    ('exact', 'exact', ['ACGTACGT', 'ACGTACGT']),
+    ('irregular', 'irregular lines', ['ACG', 'ACGTACGT', 'A', 'ACGTA']),
+    ('single', 'single', ['ACGTACGTACGTACGTACGT']),
+    ('empty', 'empty', []),
+    ('blanks', 'blanks', ['ACGT  ', 'ACGT\t', 'AC']),
+    ('last', 'last contig', ['ACGTACGT', 'ACG']),
+]
+
+
+def fasta_text(records, newline='\n', final_newline=True):
+    lines = []
+    for _, header, sequence_lines in records:
+        lines.append('>' + header)
+        lines.extend(sequence_lines)
+    return newline.join(lines) + (newline if final_newline else '')
+
+
+def sequences(records):
+    return [(name, ''.join(line.rstrip() for line in lines).encode())
+            for name, _, lines in records]
+
+
+class FastaIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dirname.cleanup)
+
+    def write(self, text, name='assembly.fa', compressed=False):
+        path = os.path.join(self.dirname.name, name)
+        if compressed:
+            with bgzf.BgzfWriter(path) as f:
+                f.write(text.encode())
+        else:
+            with open(path, 'w', newline='') as f:
+                f.write(text)
+        return path
+
+    def assertRoundTrip(self, path, records):
+        expected = sequences(records)
+        self.assertEqual([(record.name.split(' ')[0], record.sequence)
+                          for record in fasta.read_fasta(path)], expected)
+        self.assertEqual([record.length for record in fasta.read_fasta(path, headers_only=True)],
+                         [len(sequence) for _, sequence in expected])
+        fasta.write_index(path)
+        index = fasta.read_index(path)
+        self.assertEqual(list(index), [name for name, _ in expected])
+        self.assertEqual([entry.length for entry in index.values()],
+                         [len(sequence) for _, sequence in expected])
+        # Sequences come in fasta order, whatever the order of the names.
+        names = [name for name, _ in reversed(expected)] + ['missing']
+        self.assertEqual(list(fasta.read_sequences(path, names, index)), expected)
+        self.assertEqual(list(fasta.read_sequences(path, names, headers=True)),
+                         [(header, sequence) for (_, header, _), (_, sequence)
+                          in zip(records, expected)])
+        for name, sequence in expected:
+            self.assertEqual(list(fasta.read_sequences(path, [name])), [(name, sequence)])
+
+    def test_regular_lines(self):
+        path = self.write(fasta_text(RECORDS))
+        index = fasta.read_index(path)
+        self.assertEqual(index['regular'], fasta.IndexEntry(19, len('>regular first contig\n'),
+                                                            8, 9))
+        self.assertEqual(index['single'][2:], (20, 21))
+        self.assertRoundTrip(path, RECORDS)
+
+    def test_irregular_lines(self):
+        path = self.write(fasta_text(RECORDS))
+        entry = fasta.read_index(path)['irregular']
+        # Indexed as one line spanning the record.
+        self.assertEqual(entry.linebases, 17)
+        self.assertEqual(entry.linewidth, len('ACG\nACGTACGT\nA\nACGTA\n'))
+        self.assertRoundTrip(path, RECORDS)
+
+    def test_crlf(self):
+        path = self.write(fasta_text(RECORDS, '\r\n'))
+        entry = fasta.read_index(path)['regular']
+        self.assertEqual(entry[2:], (8, 10))
+        self.assertRoundTrip(path, RECORDS)
+
+    def test_final_line_without_newline(self):
+        for newline in ['\n', '\r\n']:
+            path = self.write(fasta_text(RECORDS, newline, final_newline=False))
+            self.assertRoundTrip(path, RECORDS)
+        path = self.write(fasta_text(RECORDS[:1], final_newline=False), 'one.fa')
+        self.assertRoundTrip(path, RECORDS[:1])
+        path = self.write('>header only', 'header.fa')
+        self.assertRoundTrip(path, [('header', 'header only', [])])
+
+    def test_compressed(self):
+        for newline in ['\n', '\r\n']:
+            for final_newline in [True, False]:
+                text = fasta_text(RECORDS, newline, final_newline)
+                path = self.write(text, 'assembly.fa.gz', compressed=True)
+                self.assertRoundTrip(path, RECORDS)
+
+    def test_index_replaced(self):
+        path = self.write(fasta_text(RECORDS))
+        fasta.write_index(path)
+        path = self.write(fasta_text(RECORDS[:2]))
+        fasta.write_index(path)
+        self.assertEqual(list(fasta.read_index(path)), ['regular', 'exact'])
+        self.assertEqual(sorted(os.listdir(self.dirname.name)),
+                         ['assembly.fa', 'assembly.fa.fai'])
@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import random
+import tempfile
+import unittest
+import threading
+from subprocess import CalledProcessError
+from unittest import mock
+
+from app import app, bgzf
+from app.resources.assemblies import find_essential_genes_per_contig, Subprocesses
+
+
+# Predicts a protein per started 300 bases of every contig.
+PRODIGAL = '''#!{python}
+import os, sys, time
+if os.environ.get('STUB_SLEEP'):
+    time.sleep(float(os.environ['STUB_SLEEP']))
+def arg(flag):
+    return sys.argv[sys.argv.index(flag) + 1]
+with open(arg('-i')) as f, open(arg('-a'), 'w') as out:
+    records = f.read().split('>')[1:]
+    for record in records:
+        header, *lines = record.splitlines()
+        name, length = header.split(' ')[0], len(''.join(lines))
+        for i in range(1, length // 300 + 2):
+            out.write('>{{}}_{{}} # gene\\nMK\\n'.format(name, i))
+'''
+
+# Assigns every protein an essential gene based on its name.
+HMMSEARCH = '''#!{python}
+import os, sys
+with open(os.environ['STUB_LOG'], 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\\n')
+tblout = sys.argv[sys.argv.index('--tblout') + 1]
+with open(sys.argv[-1]) as f, open(tblout, 'w') as out:
+    out.write('# target name  accession  query name\\n')
+    for line in f:
+        if line.startswith('>'):
+            protein = line[1:].split(' ')[0]
+            gene = 'TIGR{{:05}}'.format(sum(map(ord, protein)) % 7)
+            out.write('{{}}  -  {{}}  -  1e-10  100.0\\n'.format(protein, gene))
+'''
+
+
+class ShardedGeneSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dirname.cleanup)
+        executables = {}
+        for name, source in [('PRODIGAL', PRODIGAL), ('HMMSEARCH', HMMSEARCH)]:
+            path = os.path.join(self.dirname.name, name.lower())
+            with open(path, 'w') as f:
+                f.write(source.format(python=sys.executable))
+            os.chmod(path, 0o755)
+            executables[name] = path
+        config = mock.patch.dict(app.config, executables)
+        config.start()
+        self.addCleanup(config.stop)
+        self.log_path = os.path.join(self.dirname.name, 'hmmsearch.log')
+        environ = mock.patch.dict(os.environ, {'STUB_LOG': self.log_path})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        rng = random.Random(0)
+        self.fasta = ''
+        for i in range(40):
+            sequence = ''.join(rng.choice('ACGT') for _ in range(rng.randrange(50, 2000)))
+            lines = [sequence[j:j + 60] for j in range(0, len(sequence), 60)]
+            self.fasta += '>contig_{} description\n{}\n'.format(i, '\n'.join(lines))
+        self.fasta_path = os.path.join(self.dirname.name, 'assembly.fa')
+        with open(self.fasta_path, 'w') as f:
+            f.write(self.fasta)
+
+    def search(self, path, processes):
+        genes = find_essential_genes_per_contig(path, processes)
+        return {contig: sorted(found) for contig, found in genes.items()}
+
+    def hmmsearch_calls(self):
+        with open(self.log_path) as f:
+            calls = f.read().splitlines()
+        os.remove(self.log_path)
+        return calls
+
+    def test_shards_match_single_run(self):
+        expected = self.search(self.fasta_path, 1)
+        self.assertEqual(len(expected), 40)
+        for processes in [2, 3, 8]:
+            self.assertEqual(self.search(self.fasta_path, processes), expected)
+
+    def test_compressed_assembly(self):
+        expected = self.search(self.fasta_path, 1)
+        compressed_path = self.fasta_path + '.gz'
+        with bgzf.BgzfWriter(compressed_path) as f:
+            f.write(self.fasta.encode())
+        self.assertEqual(self.search(compressed_path, 1), expected)
+        self.assertEqual(self.search(compressed_path, 4), expected)
+
+    def test_cpu_only_limited_when_sharded(self):
+        self.search(self.fasta_path, 1)
+        self.assertEqual(['--cpu' in call.split(' ') for call in self.hmmsearch_calls()],
+                         [False])
+        self.search(self.fasta_path, 3)
+        calls = self.hmmsearch_calls()
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(all('--cpu 1' in call for call in calls))
+
+    def test_terminate(self):
+        scratch = os.path.join(self.dirname.name, 'scratch')
+        os.mkdir(scratch)
+        subprocesses = Subprocesses()
+        errors = []
+
+        def search():
+            try:
+                find_essential_genes_per_contig(self.fasta_path, 4, subprocesses)
+            except CalledProcessError as e:
+                errors.append(e)
+
+        with mock.patch.dict(os.environ, {'STUB_SLEEP': '60'}), \
+                mock.patch.object(tempfile, 'tempdir', scratch):
+            thread = threading.Thread(target=search)
+            thread.start()
+            while len(subprocesses.running) < 4:
+                time.sleep(.01)
+            running = list(subprocesses.running)
+            start = time.time()
+            subprocesses.terminate()
+            thread.join(10)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(all(process.poll() is not None for process in running))
+        self.assertEqual(os.listdir(scratch), [])
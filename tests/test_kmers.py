@@ -0,0 +1,52 @@
+import random
+import unittest
+from itertools import product
+from collections import Counter
+
+import numpy as np
+
+from app import utils
+
+
+def counter_frequencies(sequence):
+    # The fourmer frequencies as save_contigs calculated them before.
+    fourmers = [''.join(fourmer) for fourmer in product('atcg', repeat=4)]
+    sequence = sequence.lower()
+    fourmer_count = len(sequence) - 4 + 1
+    counts = Counter([sequence[k:k+4] for k in range(fourmer_count)])
+    return [counts[fourmer] / fourmer_count for fourmer in fourmers]
+
+
+class KmerFrequenciesTest(unittest.TestCase):
+    def test_order(self):
+        self.assertEqual(utils.kmers(4), [''.join(kmer) for kmer in product('atcg', repeat=4)])
+        frequencies = utils.kmer_frequencies('AAAAT')
+        self.assertEqual(frequencies[utils.kmers(4).index('aaaa')], .5)
+        self.assertEqual(frequencies[utils.kmers(4).index('aaat')], .5)
+
+    def test_same_as_counter(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            length = rng.randrange(4, 300)
+            alphabet = rng.choice(['ACGT', 'acgt', 'ACGTacgt', 'ACGTN', 'ACGTNNNNNRY'])
+            sequence = ''.join(rng.choice(alphabet) for _ in range(length))
+            self.assertEqual(utils.kmer_frequencies(sequence).tolist(),
+                             counter_frequencies(sequence), sequence)
+            self.assertEqual(utils.kmer_frequencies(sequence.encode()).tolist(),
+                             counter_frequencies(sequence), sequence)
+
+    def test_ambiguous_bases(self):
+        self.assertEqual(utils.kmer_frequencies('NNNNNN').tolist(), counter_frequencies('NNNNNN'))
+        self.assertEqual(utils.kmer_frequencies('ACGTNACGT').tolist(),
+                         counter_frequencies('ACGTNACGT'))
+        self.assertEqual(utils.kmer_frequencies('ACGTNACGT').sum(), 2 / 6)
+
+    def test_short_contigs(self):
+        for sequence in ['', 'A', 'AC']:
+            self.assertEqual(utils.kmer_frequencies(sequence).tolist(),
+                             counter_frequencies(sequence))
+        # The old code divided by zero on contigs of 3 bases.
+        self.assertTrue(np.array_equal(utils.kmer_frequencies('ACG'), np.zeros(4 ** 4)))
+        frequencies = utils.kmer_frequencies('ACGT')
+        self.assertEqual(frequencies.tolist(), counter_frequencies('ACGT'))
+        self.assertEqual(frequencies.sum(), 1)